@@ -15,6 +15,18 @@ class ServiceAdmin(admin.ModelAdmin):
         "host_token",
         "client_token",
         "allow_public_code",
+        "host_grace_period",
+        "max_guests",
+        "raw_relay",
+        "validate_json",
+        "coalesce_presence",
+        "history_size",
+        "client_rate_limit",
+        "guest_rate_limit",
+        "service_rate_limit",
+        "rate_limit_policy",
+        "backlog_limit",
+        "backlog_policy",
     ]
     readonly_fields = [
         "created_on",
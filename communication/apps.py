@@ -6,9 +6,6 @@ class CommunicationConfig(AppConfig):
     name = "communication"
 
     def ready(self):
-        from django.db import connection
-
-        if connection.connection and connection.connection.is_connected():
-            # Clear the sessions table on app startup
-            from django.contrib.sessions.models import Session
-            Session.objects.all().delete()
+        # Sessions left behind by a previous run are reconciled by the first
+        # connection, or by `manage.py reconcile` before starting the server
+        from . import signals
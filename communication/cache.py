@@ -0,0 +1,146 @@
+import asyncio, threading, time
+from collections import OrderedDict
+from redis import Redis, RedisError
+from django.conf import settings
+from channels_redis.utils import decode_hosts
+
+# Redis pubsub channel used to evict entries in every worker process
+INVALIDATION_CHANNEL = "omni:token_invalidation"
+
+
+# Per-process cache of resolved tokens, public codes and sessions
+class TokenCache:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Counts invalidations, so loads can tell whether their service was
+        # invalidated while they were loading
+        self.generation = 0
+        self.invalidated = {}
+        self.cleared = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires, tag, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    # Values loaded since `generation` are discarded if their service has been
+    # invalidated since, as they may predate the change
+    def set(self, key, value, tag, generation=None):
+        with self.lock:
+            if generation is not None and generation < max(
+                self.invalidated.get(tag, 0), self.cleared
+            ):
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, tag, value)
+            self.entries.move_to_end(key)
+
+            # Evict least recently used entries
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # Fetch a value, loading it from the database if it isn't cached
+    async def get_or_load(self, key, load):
+        value = self.get(key)
+        if value is None:
+            generation = self.generation
+            value = await load()
+            if value is not None:
+                self.set(key, value, cache_tag(value), generation)
+        return value
+
+    # Evict every entry belonging to a service
+    def invalidate(self, tag):
+        with self.lock:
+            self.generation += 1
+            self.invalidated[tag] = self.generation
+            keys = [key for key, entry in self.entries.items() if entry[1] == tag]
+            for key in keys:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.cleared = self.generation
+            self.invalidated.clear()
+            self.entries.clear()
+
+
+token_cache = TokenCache(
+    ttl=getattr(settings, "OMNI_TOKEN_CACHE_TTL", 60),
+    max_size=getattr(settings, "OMNI_TOKEN_CACHE_SIZE", 4096),
+)
+
+
+# Entries are tagged with the host token of the service they belong to
+def cache_tag(value):
+    service_id = getattr(value, "service_id", None)
+    if service_id is None:
+        service_id = value.pk
+    return str(service_id)
+
+
+# Publishing
+
+_publisher = None
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        config = settings.CHANNEL_LAYERS["default"].get("CONFIG", {})
+        host = decode_hosts(config.get("hosts"))[0].copy()
+        if "address" in host:
+            _publisher = Redis.from_url(host.pop("address"), **host)
+        else:
+            _publisher = Redis(**host)
+    return _publisher
+
+
+# Evict a service's entries locally and in all other worker processes
+def publish_invalidation(tag):
+    token_cache.invalidate(tag)
+    try:
+        get_publisher().publish(INVALIDATION_CHANNEL, tag)
+    except RedisError as error:
+        print(f"! Unable to publish cache invalidation for {tag}: {error}")
+
+
+# Subscribing
+
+_listeners = {}
+
+
+# Start listening for invalidations, once per event loop
+def listen_for_invalidations(channel_layer):
+    loop = asyncio.get_running_loop()
+    if loop not in _listeners:
+        _listeners[loop] = loop.create_task(_listen(channel_layer))
+
+
+async def _listen(channel_layer):
+    while True:
+        try:
+            pubsub = channel_layer.connection(0).pubsub()
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+
+            # Invalidations may have been missed while not subscribed
+            token_cache.clear()
+
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    token_cache.invalidate(message["data"].decode())
+        except (RedisError, OSError) as error:
+            print(f"! Lost cache invalidation channel: {error}")
+            await asyncio.sleep(1)
@@ -0,0 +1,110 @@
+import random, threading
+from redis import RedisError
+from django.conf import settings
+from .cache import get_publisher
+
+CODE_CHARS = "ABCDEFGHIJKLMNOPQRSTUVXYZ"
+CODE_SIZE = 4
+
+# Redis sets of pre-generated codes waiting to be handed out, and codes in use
+FREE_CODES = "omni:codes:free"
+USED_CODES = "omni:codes:used"
+
+# Move a random free code to the used set, returning it and how many are left
+ALLOCATE = """
+local code = redis.call('SPOP', KEYS[1])
+if code then
+    redis.call('SADD', KEYS[2], code)
+end
+return {code, redis.call('SCARD', KEYS[1])}
+"""
+
+# Move codes from the used set back to the free set
+RELEASE = """
+for _, code in ipairs(ARGV) do
+    if redis.call('SREM', KEYS[2], code) == 1 then
+        redis.call('SADD', KEYS[1], code)
+    end
+end
+"""
+
+# Add new codes to the free set, skipping those in use
+REFILL = """
+for _, code in ipairs(ARGV) do
+    if redis.call('SISMEMBER', KEYS[2], code) == 0 then
+        redis.call('SADD', KEYS[1], code)
+    end
+end
+return redis.call('SCARD', KEYS[1])
+"""
+
+
+def random_code():
+    return "".join(random.sample(CODE_CHARS, CODE_SIZE))
+
+
+# Pool of free public codes kept in Redis, so that every worker can hand out a
+# code in a single atomic step instead of querying the database for a free one
+class CodePool:
+    def __init__(self, size, low_water):
+        self.size = size
+        self.low_water = low_water
+        self.scripts = None
+        self.refilling = threading.Lock()
+
+    def script(self, name):
+        if self.scripts is None:
+            redis = get_publisher()
+            self.scripts = {
+                "allocate": redis.register_script(ALLOCATE),
+                "release": redis.register_script(RELEASE),
+                "refill": redis.register_script(REFILL),
+            }
+        return self.scripts[name]
+
+    # Take a free code, or None if Redis can't provide one
+    def allocate(self):
+        try:
+            code, remaining = self.script("allocate")(keys=[FREE_CODES, USED_CODES])
+            if code is None:
+                # The pool is filled on first use
+                self.refill()
+                code, remaining = self.script("allocate")(keys=[FREE_CODES, USED_CODES])
+        except RedisError as error:
+            print(f"! Unable to allocate code: {error}")
+            return None
+
+        if remaining < self.low_water:
+            self.refill_in_background()
+        return code.decode() if code else None
+
+    def release(self, *codes):
+        codes = [code for code in codes if code]
+        if not codes:
+            return
+        try:
+            self.script("release")(keys=[FREE_CODES, USED_CODES], args=codes)
+        except RedisError as error:
+            print(f"! Unable to release codes {', '.join(codes)}: {error}")
+
+    def refill(self):
+        codes = {random_code() for _ in range(self.size)}
+        return self.script("refill")(keys=[FREE_CODES, USED_CODES], args=list(codes))
+
+    def refill_in_background(self):
+        if self.refilling.acquire(blocking=False):
+            threading.Thread(target=self.refill_once, daemon=True).start()
+
+    def refill_once(self):
+        try:
+            self.refill()
+        except RedisError as error:
+            print(f"! Unable to refill code pool: {error}")
+        finally:
+            self.refilling.release()
+
+
+code_pool = CodePool(
+    size=getattr(settings, "OMNI_CODE_POOL_SIZE", 1000),
+    low_water=getattr(settings, "OMNI_CODE_POOL_LOW_WATER", 250),
+)
@@ -1,21 +1,70 @@
-import json, random, uuid
+import asyncio, json, msgpack, random, time, uuid
+from collections import defaultdict
 from redis import Redis
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from channels.exceptions import ChannelFull
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
-from channels_redis.core import RedisChannelLayer
-from .utils import is_uuid, explain_websocket_code
+from .cache import listen_for_invalidations
+from .counters import SessionCounters, flush_periodically
+from .heartbeat import IDLE_TIMEOUT, PING_INTERVAL, heartbeats, reap_periodically
+from .history import SessionHistory, offset_key
+from .layers import LocalFanoutChannelLayer
+from .ratelimit import TokenBucket, service_budget
+from .reconcile import reconcile_periodically
+from .registry import UserRegistry
+from .resolver import resolve_token
+from .state import SessionState, merge_patch
+from .store import session_store
+from .teardown import end_session, schedule_teardown, sweep_periodically
+from .utils import explain_websocket_code
 
 from .models import Service, Session
 
+# Messages about the connection itself, which are handled in raw relay mode too
+CONNECTION_MESSAGES = (
+    "server_ping",
+    "server_pong",
+    "server_subscribe",
+    "server_unsubscribe",
+)
+
+# Serialize broadcasts once in the sender instead of once per receiver
+ENCODE_BROADCASTS_ONCE = getattr(settings, "OMNI_ENCODE_BROADCASTS_ONCE", False)
+
+# Longest time, and most joins and leaves, buffered before a presence update
+PRESENCE_INTERVAL = getattr(settings, "OMNI_PRESENCE_INTERVAL", 250) / 1000
+PRESENCE_MAX_EVENTS = getattr(settings, "OMNI_PRESENCE_MAX_EVENTS", 100)
+
+# Most messages sent in one server_replay message
+REPLAY_BATCH = getattr(settings, "OMNI_HISTORY_REPLAY_BATCH", 100)
+
+# Messages waiting for a client or guest before its backlog policy kicks in
+BACKLOG_LIMIT = getattr(settings, "OMNI_BACKLOG_LIMIT", 100)
+
 
 class OmniConsumer(AsyncJsonWebsocketConsumer):
-    channel_layer: RedisChannelLayer
+    channel_layer: LocalFanoutChannelLayer
 
     authorized = False
     is_host = False
     is_guest = False
     allow_public_code = False
+    raw_relay = False
+    validate_json = True
+    use_msgpack = False
+    coalesce_presence = False
+    rate_limit = None
+    service_rate_limit = None
+    rate_limit_policy = Service.RATE_LIMIT_DROP
+    closing = False
+    state = None
+    history_size = None
+    replayed_until = None
+    host_grace_period = None
+    lag_dropped = 0
+    lag_reported = 0
+    session_closed = False
     session_code = None
     host_token = None
     host_group = None
@@ -25,9 +74,21 @@ class OmniConsumer(AsyncJsonWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super(OmniConsumer, self).__init__(*args, **kwargs)
         assert self.host_token is None
+        # Buffered joins (user to join event) and leaves (users)
+        self.presence_added = {}
+        self.presence_removed = set()
+        self.presence_flush = None
+        self.heartbeat = None
+        self.last_seen = time.monotonic()
 
     async def connect(self):
         print(f"+ {self} Connected")
+        listen_for_invalidations(self.channel_layer)
+        session_store.start(self.channel_layer)
+        flush_periodically(self.channel_layer)
+        sweep_periodically(self.channel_layer)
+        reap_periodically(self.channel_layer)
+        reconcile_periodically(self.channel_layer)
 
         await self.accept()
         await self.send_json(
@@ -36,20 +97,38 @@ class OmniConsumer(AsyncJsonWebsocketConsumer):
 
     async def disconnect(self, code):
         print(f"- {self} Disconnected ({explain_websocket_code(code)})")
+        if self.presence_flush:
+            self.presence_flush.cancel()
+        if self.heartbeat:
+            self.heartbeat.cancel()
+        if self.authorized:
+            await heartbeats.unregister(self.channel_layer, self.channel_name)
 
-        if self.is_host:
-            # Clear service code
-            if code != 4000:
-                await self.clear_session(self.session_code)
+        # The session ends with its host, unless the host was replaced or may
+        # still return
+        if self.is_host and self.authorized and code != 4000:
+            if not self.host_grace_period:
+                await self.end_session()
+                return await super().disconnect(code)
+            await self.leave_session()
 
+        elif self.is_host and self.guest_group:
             # Annouce departure to clients
             await self.channel_layer.group_send(
                 self.guest_group,
                 {"type": "on_kick", "message": "Session ended by host"},
             )
 
-        # Remove the user's channel name from Redis
-        await self.redis_delete(f"user:{self.short_name}")
+        # Everything was already removed when the session ended
+        if self.session_closed:
+            return await super().disconnect(code)
+
+        # Remove the user's channel name from the session registry
+        if self.host_group:
+            await self.registry.remove(self.short_name)
+
+        if self.authorized and not self.is_host:
+            await self.counters.add(self.session_code, self.title, -1)
 
         if self.host_group:
             await self.channel_layer.group_discard(self.host_group, self.channel_name)
@@ -69,6 +148,76 @@ class OmniConsumer(AsyncJsonWebsocketConsumer):
 
         await super().disconnect(code)
 
+    # Kick the guests and remove the session's groups and registry in bulk,
+    # so guests don't each clean up and announce their departure
+    async def end_session(self):
+        start = time.perf_counter()
+
+        # Announce departure to clients
+        await self.channel_layer.group_send(
+            self.client_group,
+            {"type": "on_leave", "role": self.title, "user": self.short_name},
+        )
+
+        deleted, members = await end_session(
+            self.channel_layer,
+            self.session_code,
+            self.host_group,
+            self.client_group,
+            self.guest_group,
+        )
+        if not deleted:
+            print(f"- {self} Cannot clear session {self.session_code}")
+
+        elapsed = time.perf_counter() - start
+        print(
+            f"- {self} Ended session {self.session_code} with "
+            f"{members[self.guest_group]} guests in {elapsed * 1000:.1f} ms"
+        )
+
+    # Keep the session open for the host to return, ending it after the grace
+    # period otherwise
+    async def leave_session(self):
+        await schedule_teardown(
+            self.channel_layer, self.session_code, self.host_grace_period
+        )
+        await self.channel_layer.group_send(
+            self.client_group,
+            {"type": "on_host_away", "seconds": self.host_grace_period},
+        )
+        print(
+            f"- {self} Keeping session {self.session_code} open for "
+            f"{self.host_grace_period} s"
+        )
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        self.last_seen = time.monotonic()
+
+        # Messages over the rate limits are never decoded
+        if self.authorized and not self.is_host and not await self.within_rate_limits():
+            return await self.exceed_rate_limit()
+
+        if text_data is not None:
+            # Services in raw relay mode forward frames without re-encoding them
+            if self.authorized and self.raw_relay:
+                return await self.relay_raw(text_data)
+            return await super().receive(text_data=text_data, **kwargs)
+
+        # Binary frames are MessagePack for connections that negotiated it, and
+        # a binary first message negotiates it. Other binary frames are opaque.
+        if self.use_msgpack or not self.authorized:
+            self.use_msgpack = True
+            try:
+                content = msgpack.unpackb(bytes_data)
+                # Binary and extension values can't reach JSON receivers, nor
+                # the history and state, so messages holding them are malformed
+                json.dumps(content)
+            except (TypeError, ValueError, msgpack.UnpackException):
+                content = None
+            return await self.receive_json(content)
+
+        return await self.relay_bytes(bytes_data)
+
     async def receive_json(self, content):
         # print(f"> {self} {content}")
 
@@ -85,36 +234,431 @@ class OmniConsumer(AsyncJsonWebsocketConsumer):
             print(f"> {self} {content}")
             return await self.authenticate(content)
 
+        # Heartbeats only show that the connection is alive
+        if content.get("type") == "server_pong":
+            return
+        if content.get("type") == "server_ping":
+            return await self.send_json({"type": "server_pong"})
+
+        # Hosts may send many messages in a single frame
+        if self.is_host and content.get("type") == "server_batch":
+            return await self.send_batch(content.get("messages"))
+
+        # Hosts may publish a state for everyone, including later joiners
+        if self.is_host and content.get("type") == "server_state":
+            return await self.publish_state(content.get("state"))
+        if self.is_host and content.get("type") == "server_state_patch":
+            return await self.publish_state_patch(content.get("patch"))
+
+        # Clients and guests may only want broadcasts on some topics
+        if not self.is_host and content.get("type") == "server_subscribe":
+            return await self.subscribe(content.get("topics"))
+        if not self.is_host and content.get("type") == "server_unsubscribe":
+            return await self.unsubscribe(content.get("topics"))
+
         # Set message sender id
-        target_user = content.get("user")
+        target_users = self.target_users(content)
         if not self.is_host:
             content["user"] = self.short_name
 
-        # If the message has a targeted user, send the message to the specific user's channel
-        if target_user and self.is_host:
-            channel_name = await self.redis_get(f"user:{target_user}")
-            if channel_name:
-                return await self.channel_layer.send(
-                    channel_name,
-                    {"type": "on_send", "data": content},
-                )
-            else:
-                return await self.send_json(
-                    {"type": "server_error", "message": f"User {target_user} not found"}
+        # If the message has targeted users, send the message to their channels
+        if target_users is not None and self.is_host:
+            return await self.send_to_users(
+                target_users,
+                {
+                    "type": "on_send",
+                    "data": content,
+                    "key": self.message_topic(content),
+                },
+            )
+
+        return await self.broadcast(content)
+
+    async def broadcast(self, content):
+        # Host broadcasts are kept for clients resuming a dropped connection
+        offset = None
+        if self.is_host and self.history_size:
+            offset = await self.history.append(await self.encode_json(content))
+            content["offset"] = offset
+
+        # Broadcast the message to the group, encoding it once for all receivers
+        if ENCODE_BROADCASTS_ONCE:
+            event = {"type": "on_send_text", "text": await self.encode_json(content)}
+        else:
+            event = {"type": "on_send", "data": content}
+        if offset:
+            event["offset"] = offset
+
+        # Subscribers, and slow receivers keeping only the latest message of
+        # each type, tell messages apart by their topic
+        event["topic"] = self.message_topic(content)
+        return await self.channel_layer.group_send(self.other_group, event)
+
+    # Forward a text frame as is, only parsing a host's frame when validation
+    # is enabled or when it may be targeting a user
+    async def relay_raw(self, text):
+        content = None
+        if '"server_' in text:
+            # Heartbeats, subscriptions and server messages from hosts are
+            # handled as usual
+            try:
+                content = json.loads(text)
+            except ValueError:
+                content = None
+            message_type = content.get("type") if isinstance(content, dict) else None
+            if message_type in CONNECTION_MESSAGES or (
+                self.is_host and str(message_type).startswith("server_")
+            ):
+                return await self.receive_json(content)
+
+        # Frames from clients and guests are always checked, as they are
+        # embedded in an envelope whose sender id they could otherwise forge
+        must_validate = self.validate_json or not self.is_host
+        if must_validate or '"user"' in text:
+            try:
+                content = json.loads(text)
+            except ValueError:
+                content = None
+            if must_validate and not isinstance(content, dict):
+                print(f"> {self} {text}")
+                await self.send_json(
+                    {
+                        "type": "server_error",
+                        "message": "Malformed message. Expected JSON.",
+                    }
                 )
+                return await self.close()
 
-        # Broadcast the message to the group
+        # Host messages are sent unchanged to their target or the whole group
+        if self.is_host:
+            event = {"type": "on_send_text", "text": text}
+            if isinstance(content, dict) and self.target_users(content) is not None:
+                event["key"] = self.message_topic(content)
+                return await self.send_to_users(self.target_users(content), event)
+            # Only messages that were parsed anyway can be filtered by topic
+            if isinstance(content, dict):
+                event["topic"] = self.message_topic(content)
+            return await self.channel_layer.group_send(self.other_group, event)
+
+        # Other messages are wrapped in an envelope carrying the sender id
+        envelope = f'{{"user": {json.dumps(self.short_name)}, "data": {text}}}'
         return await self.channel_layer.group_send(
-            self.other_group,
-            {"type": "on_send", "data": content},
+            self.other_group, {"type": "on_send_text", "text": envelope}
+        )
+
+    # Forward an opaque binary frame to the other group
+    async def relay_bytes(self, data):
+        event = {"type": "on_send_bytes", "bytes": data}
+        if not self.is_host:
+            event["user"] = self.short_name
+        return await self.channel_layer.group_send(self.other_group, event)
+
+    # Targeted messages
+
+    # A message's "user" field targets either one user or a list of users,
+    # which may be empty. Returns None for messages that aren't targeted.
+    @staticmethod
+    def target_users(content):
+        users = content.get("user")
+        if isinstance(users, list):
+            return list(dict.fromkeys(str(user) for user in users if user))
+        if users:
+            return [str(users)]
+        return None
+
+    async def send_to_users(self, target_users, event):
+        channels = await self.find_channels(target_users)
+        sent = await asyncio.gather(
+            *(self.send_to_channel(channel, event) for channel in channels.values())
+        )
+        await self.report_missing_users(
+            [user for user in target_users if user not in channels]
+        )
+        await self.report_lagging_users(
+            [user for user, ok in zip(channels, sent) if not ok]
+        )
+
+    # Send to a channel, returning False if its worker's queue is full
+    async def send_to_channel(self, channel, event):
+        try:
+            await self.channel_layer.send(channel, event)
+            return True
+        except ChannelFull:
+            return False
+
+    # Deliver a host's batch, keeping the order of messages for each receiver
+    async def send_batch(self, messages):
+        if not isinstance(messages, list) or not all(
+            isinstance(message, dict) for message in messages
+        ):
+            message = (
+                'Malformed batch. Expected {"type": "server_batch", "messages": [...]}'
+            )
+            return await self.send_json({"type": "server_error", "message": message})
+
+        # Look up every targeted user at once
+        channels = await self.find_channels(
+            {
+                user: None
+                for message in messages
+                for user in self.target_users(message) or []
+            }
+        )
+
+        pending = defaultdict(list)
+        missing_users = {}
+        failed = set()
+        for message in messages:
+            target_users = self.target_users(message)
+
+            # Targeted messages queued so far must arrive before a broadcast
+            if target_users is None:
+                failed.update(await self.send_pending(pending))
+                await self.broadcast(message)
+                continue
+
+            for user in target_users:
+                if user in channels:
+                    pending[channels[user]].append(message)
+                else:
+                    missing_users[user] = None
+
+        failed.update(await self.send_pending(pending))
+        await self.report_missing_users(list(missing_users))
+
+        # Users whose worker's queue was full for any of their messages
+        users = {channel: user for user, channel in channels.items()}
+        await self.report_lagging_users([users[channel] for channel in failed])
+
+    async def send_pending(self, pending):
+        channels = list(pending)
+        sent = await asyncio.gather(
+            *(
+                self.send_to_channel(
+                    channel,
+                    {
+                        "type": "on_send_many",
+                        "data": pending[channel],
+                        "key": [
+                            self.message_topic(message) for message in pending[channel]
+                        ],
+                    },
+                )
+                for channel in channels
+            )
+        )
+        pending.clear()
+        return [channel for channel, ok in zip(channels, sent) if not ok]
+
+    # Map users to their channel names in a single Redis round-trip
+    async def find_channels(self, users):
+        return await self.registry.get_many(users)
+
+    async def report_missing_users(self, users):
+        if len(users) == 1:
+            message = f"User {users[0]} not found"
+        elif users:
+            message = f"Users {', '.join(users)} not found"
+        else:
+            return
+        await self.send_json(
+            {"type": "server_error", "message": message, "users": users}
+        )
+
+    async def report_lagging_users(self, users):
+        for user in users:
+            await self.send_json({"type": "server_lag", "user": user, "dropped": 1})
+
+    # Slow receivers
+
+    async def dispatch(self, message):
+        await super().dispatch(message)
+        if self.authorized and not self.is_host:
+            await self.report_lag()
+
+    # Tell hosts about messages dropped because this connection fell behind,
+    # at most once a second
+    async def report_lag(self):
+        self.lag_dropped += self.channel_layer.dropped.pop(self.channel_name, 0)
+        if not self.lag_dropped or time.monotonic() - self.lag_reported < 1:
+            return
+
+        await self.channel_layer.group_send(
+            self.host_group,
+            {
+                "type": "on_lag",
+                "user": self.short_name,
+                "dropped": self.lag_dropped,
+                "backlog": self.channel_layer.backlog(self.channel_name),
+            },
+        )
+        self.lag_dropped = 0
+        self.lag_reported = time.monotonic()
+
+    # Retained state
+
+    async def publish_state(self, state):
+        self.state = state
+        await self.session_state.set(state)
+        await self.broadcast({"type": "server_state", "state": state})
+
+    # Merge a patch into the state. The patch is stored before it is sent, so
+    # users joining meanwhile may get it twice, which changes nothing.
+    async def publish_state_patch(self, patch):
+        if not isinstance(patch, dict):
+            message = 'Malformed patch. Expected {"type": "server_state_patch", "patch": {...}}'
+            return await self.send_json({"type": "server_error", "message": message})
+
+        if self.state is None:
+            self.state = await self.session_state.get()
+        self.state = merge_patch(self.state, patch)
+        await self.session_state.set(self.state)
+        await self.broadcast({"type": "server_state_patch", "patch": patch})
+
+    async def send_state(self):
+        text = await self.session_state.get_text()
+        if text is None:
+            return
+        if self.use_msgpack:
+            return await self.send_json(
+                {"type": "server_state", "state": json.loads(text)}
+            )
+        await self.send(text_data=f'{{"type": "server_state", "state": {text}}}')
+
+    # History
+
+    # Send the messages after an offset in batches, returning False if some of
+    # them are no longer kept
+    async def replay(self, offset):
+        oldest = await self.history.oldest() if self.history_size else None
+        try:
+            complete = oldest is not None and offset_key(offset) >= offset_key(oldest)
+        except ValueError:
+            complete = False
+        if not complete:
+            await self.send_json(
+                {
+                    "type": "server_replay",
+                    "messages": [],
+                    "more": False,
+                    "truncated": True,
+                }
+            )
+            return False
+
+        while True:
+            entries = await self.history.read_after(offset, REPLAY_BATCH)
+            messages = []
+            for offset, text in entries:
+                message = json.loads(text)
+                message["offset"] = offset
+                if self.channel_layer.subscribed(
+                    self.channel_name, {"topic": self.message_topic(message)}
+                ):
+                    messages.append(message)
+            more = len(entries) == REPLAY_BATCH
+            await self.send_json(
+                {"type": "server_replay", "messages": messages, "more": more}
+            )
+            if not more:
+                break
+
+        # Live messages that were queued during the replay are not sent again
+        self.replayed_until = offset_key(offset)
+        return True
+
+    def replayed(self, event):
+        offset = event.get("offset")
+        if offset and self.replayed_until:
+            return offset_key(offset) <= self.replayed_until
+        return False
+
+    # Topics
+
+    # A broadcast's topic is its "topic" field, or else its type
+    @staticmethod
+    def message_topic(content):
+        topic = content.get("topic", content.get("type"))
+        return None if topic is None else str(topic)
+
+    async def subscribe(self, topics):
+        if not isinstance(topics, list):
+            message = 'Malformed subscription. Expected {"type": "server_subscribe", "topics": [...]}'
+            return await self.send_json({"type": "server_error", "message": message})
+
+        self.channel_layer.subscribe(self.channel_name, map(str, topics))
+        await self.send_subscriptions()
+
+    # Unsubscribe from some topics, or from topic filtering altogether
+    async def unsubscribe(self, topics):
+        if topics is not None and not isinstance(topics, list):
+            message = 'Malformed subscription. Expected {"type": "server_unsubscribe", "topics": [...]}'
+            return await self.send_json({"type": "server_error", "message": message})
+
+        self.channel_layer.unsubscribe(
+            self.channel_name, None if topics is None else map(str, topics)
         )
+        await self.send_subscriptions()
+
+    async def send_subscriptions(self):
+        topics = self.channel_layer.subscriptions.get(self.channel_name)
+        await self.send_json(
+            {
+                "type": "server_subscribed",
+                "topics": None if topics is None else sorted(topics),
+            }
+        )
+
+    # Heartbeat
+
+    # Ping connections that have gone quiet, and close those that stay quiet
+    async def watch_heartbeat(self):
+        interval = min(seconds for seconds in (PING_INTERVAL, IDLE_TIMEOUT) if seconds)
+        while True:
+            await asyncio.sleep(interval)
+            idle = time.monotonic() - self.last_seen
+            if IDLE_TIMEOUT and idle >= IDLE_TIMEOUT:
+                print(f"- {self} Timed out after {idle:.0f} s")
+                return await self.close(4004)
+            if PING_INTERVAL and idle >= PING_INTERVAL:
+                await self.send_json({"type": "server_ping"})
+
+    # Rate limits
+
+    async def within_rate_limits(self):
+        if self.rate_limit and not self.rate_limit.take():
+            return False
+        if self.service_rate_limit:
+            return await service_budget.take(
+                self.channel_layer.connection(0),
+                self.host_token,
+                self.service_rate_limit,
+            )
+        return True
+
+    async def exceed_rate_limit(self):
+        service_budget.record_drop(
+            self.channel_layer.connection(0), self.host_token, self.title
+        )
+        # Frames still arriving after the socket is told to close are dropped
+        if self.rate_limit_policy == Service.RATE_LIMIT_CLOSE and not self.closing:
+            self.closing = True
+            message = "Rate limit exceeded"
+            await self.send_json({"type": "server_error", "message": message})
+            await self.close(4002)
 
     async def send_json(self, content, close=False):
         # print(f"< {self} {content}")
+        if self.use_msgpack:
+            return await self.send(bytes_data=msgpack.packb(content), close=close)
         await super().send_json(content, close)
 
     # Authentication check for the user's first message
     async def authenticate(self, content):
+        # Check if MessagePack is requested for messages to this connection
+        if content.get("format") == "msgpack":
+            self.use_msgpack = True
+
         # Check if token is provided
         token = content.get("token", None)
         if not token:
@@ -122,33 +666,61 @@ class OmniConsumer(AsyncJsonWebsocketConsumer):
             await self.send_json({"type": "server_error", "message": message})
             return await self.close()
 
-        # Check if token is valid
-        if not await self.check_token(token):
+        # Check if token is valid and find the session it belongs to
+        resolution = await resolve_token(token)
+        if not resolution:
             message = "Invalid token"
             await self.send_json({"type": "server_error", "message": message})
             return await self.close()
 
-        # Force existing host to leave
-        if self.is_host and not self.allow_public_code:
-            await self.channel_layer.group_send(
-                self.my_group,
-                {"type": "on_kick", "message": "Kicked by new host"},
-            )
+        self.is_host = resolution.is_host
+        self.is_guest = resolution.is_guest
+        self.host_token = resolution.service.host_token
+        self.allow_public_code = resolution.service.allow_public_code
+        self.raw_relay = resolution.service.raw_relay
+        self.validate_json = resolution.service.validate_json
+        self.coalesce_presence = resolution.service.coalesce_presence
+        self.history_size = resolution.service.history_size
+        self.host_grace_period = resolution.service.host_grace_period
+        self.service_rate_limit = resolution.service.service_rate_limit
+        self.rate_limit_policy = resolution.service.rate_limit_policy
+        if self.is_guest:
+            rate = resolution.service.guest_rate_limit
+        else:
+            rate = resolution.service.client_rate_limit
+        if rate and not self.is_host:
+            self.rate_limit = TokenBucket(rate)
 
-        # Find existing session or create a new one
-        session = await self.find_session(token)
-        if self.is_host and self.allow_public_code:
-            session = await self.create_session()
-        elif not session:
-            self.authorized = False
+        session = resolution.session
+        if not session:
             message = "Unable to join session"
             await self.send_json({"type": "server_error", "message": message})
             return await self.close()
 
+        # Count the user in, as long as the session has room for more guests
+        if not self.is_host:
+            limit = resolution.service.max_guests if self.is_guest else None
+            if await self.counters.add(session.code, self.title, 1, limit) is None:
+                message = "Session is full"
+                await self.send_json({"type": "server_error", "message": message})
+                return await self.close(4001)
+
+        self.authorized = True
+
+        # Force existing host to leave
+        if self.is_host and not resolution.created and not resolution.resumed:
+            await self.channel_layer.group_send(
+                session.host_group,
+                {"type": "on_kick", "message": "Kicked by new host"},
+            )
+
         # Announce public code
         if self.is_host and self.allow_public_code:
             await self.send_json({"type": "server_code", "code": session.code})
-            print(f"$ {self} Created new session: {session.code}")
+            if resolution.resumed:
+                print(f"$ {self} Resumed session: {session.code}")
+            else:
+                print(f"$ {self} Created new session: {session.code}")
 
         # Set session groups
         self.session_code = session.code
@@ -156,6 +728,18 @@ class OmniConsumer(AsyncJsonWebsocketConsumer):
         self.client_group = session.client_group
         self.guest_group = session.guest_group
 
+        # Limit the messages waiting for clients and guests that fall behind
+        if not self.is_host:
+            self.channel_layer.set_backlog_limit(
+                self.channel_name,
+                resolution.service.backlog_limit or BACKLOG_LIMIT,
+                resolution.service.backlog_policy,
+            )
+
+        # Topics given up front are filtered from the very first message
+        if not self.is_host and isinstance(content.get("topics"), list):
+            self.channel_layer.subscribe(self.channel_name, map(str, content["topics"]))
+
         # Subscribe to group
         await self.channel_layer.group_add(self.my_group, self.channel_name)
         print(f"+ {self} Subscribed to '{self.my_group}'")
@@ -167,6 +751,13 @@ class OmniConsumer(AsyncJsonWebsocketConsumer):
         message = f"Authorized as {self.title}"
         await self.send_json({"type": "server_authorized", "message": message})
 
+        # Catch up on the messages missed since the given offset, or else on
+        # the state published by the host
+        if not self.is_host:
+            offset = content.get("offset")
+            if not offset or not await self.replay(str(offset)):
+                await self.send_state()
+
         # Announce that channel joined
         await self.channel_layer.group_send(
             self.other_group,
@@ -178,29 +769,96 @@ class OmniConsumer(AsyncJsonWebsocketConsumer):
             },
         )
 
-        # Store the user's channel name in Redis
-        await self.redis_set(f"user:{self.short_name}", self.channel_name)
+        # Store the user's channel name in the session registry
+        await self.registry.add(self.short_name, self.channel_name)
 
-    # Check if token matches a service
-    async def check_token(self, token):
-        service = await self.find_service(token)
-        if service:
-            self.authorized = True
-            self.host_token = service.host_token
-            self.allow_public_code = service.allow_public_code
-            return True
-        return False
+        # Watch for the connection going quiet, and let other workers clean up
+        # after it if this one stops
+        await heartbeats.register(
+            self.channel_layer,
+            self.channel_name,
+            {
+                "role": self.title,
+                "user": self.short_name,
+                "code": self.session_code,
+                "host_group": self.host_group,
+                "groups": [self.my_group]
+                + ([self.guest_group] if self.is_guest else []),
+                "other_group": self.other_group,
+                "grace": self.host_grace_period,
+            },
+        )
+        if PING_INTERVAL or IDLE_TIMEOUT:
+            self.heartbeat = asyncio.create_task(self.watch_heartbeat())
 
     # Group send functions
 
     async def on_send(self, event):
+        if self.replayed(event):
+            return
         await self.send_json(event["data"])
 
+    async def on_send_many(self, event):
+        for content in event["data"]:
+            await self.send_json(content)
+
+    async def on_send_text(self, event):
+        if self.replayed(event):
+            return
+
+        # MessagePack connections receive JSON messages converted
+        if self.use_msgpack:
+            try:
+                content = json.loads(event["text"])
+            except ValueError:
+                pass
+            else:
+                return await self.send_json(content)
+        await self.send(text_data=event["text"])
+
+    async def on_send_bytes(self, event):
+        # MessagePack connections learn who sent the frame through an envelope
+        if self.use_msgpack and "user" in event:
+            envelope = {"user": event["user"], "data": event["bytes"]}
+            return await self.send(bytes_data=msgpack.packb(envelope))
+        await self.send(bytes_data=event["bytes"])
+
+    async def on_lag(self, event):
+        await self.send_json(
+            {
+                "type": "server_lag",
+                "user": event["user"],
+                "dropped": event["dropped"],
+                "backlog": event["backlog"],
+            }
+        )
+
+    async def on_backlog_exceeded(self, event):
+        message = "Too slow to receive messages"
+        await self.send_json({"type": "server_disconnect", "message": message})
+        return await self.close(4003)
+
+    async def on_host_away(self, event):
+        message = "Host disconnected, waiting for it to return"
+        await self.send_json(
+            {
+                "type": "server_host_away",
+                "message": message,
+                "seconds": event["seconds"],
+            }
+        )
+
     async def on_kick(self, event):
+        self.session_closed = event.get("closed", False)
         await self.send_json({"type": "server_disconnect", "message": event["message"]})
         return await self.close(4000)
 
     async def on_join(self, event):
+        if self.is_host and self.coalesce_presence:
+            self.presence_removed.discard(event["user"])
+            self.presence_added[event["user"]] = event
+            return await self.buffer_presence()
+
         await self.send_json(
             {
                 "type": "server_join",
@@ -211,63 +869,57 @@ class OmniConsumer(AsyncJsonWebsocketConsumer):
         )
 
     async def on_leave(self, event):
+        if self.is_host and self.coalesce_presence:
+            # Users joining and leaving between two updates are never reported
+            if self.presence_added.pop(event["user"], None) is None:
+                self.presence_removed.add(event["user"])
+            return await self.buffer_presence()
+
         await self.send_json(
             {"type": "server_leave", "role": event["role"], "user": event["user"]}
         )
 
-    # Django database
-
-    @database_sync_to_async
-    def find_service(self, token):
-        if is_uuid(token):
-            # Check if token is a host token
-            if Service.objects.filter(host_token=token).exists():
-                self.is_host = True
-                return Service.objects.get(host_token=token)
-            # Check if token is a client token
-            if Service.objects.filter(client_token=token).exists():
-                return Service.objects.get(client_token=token)
-        elif isinstance(token, str):
-            # Check if token is a public code
-            if Session.objects.filter(code=token).exists():
-                self.is_guest = True
-                session = Session.objects.get(code=token)
-                if session.service.allow_public_code:
-                    return session.service
-
-    @database_sync_to_async
-    def create_session(self):
-        if Service.objects.filter(host_token=self.host_token).exists():
-            service = Service.objects.get(host_token=self.host_token)
-            return service.add_session()
-
-    @database_sync_to_async
-    def find_session(self, token):
-        if is_uuid(token):
-            # Fetch service from token
-            service = None
-            if Service.objects.filter(host_token=token).exists():
-                service = Service.objects.get(host_token=token)
-            elif Service.objects.filter(client_token=token).exists():
-                service = Service.objects.get(client_token=token)
-
-            # Return existing session or create a new one
-            if service and Session.objects.filter(service=service).exists():
-                return Session.objects.filter(service=service).first()
-
-        # If token is a public code, find the session
-        elif isinstance(token, str) and self.allow_public_code:
-            if Session.objects.filter(code=token).exists():
-                return Session.objects.get(code=token)
-
-    @database_sync_to_async
-    def clear_session(self, session_code):
-        if Session.objects.filter(code=session_code).exists():
-            session = Session.objects.get(code=session_code)
-            session.delete()
-            print(f"- {self} Clearing session {session_code}")
-        else:
-            print(f"- {self} Cannot clear session {session_code}")
+    # Coalesced presence
+
+    # Send buffered joins and leaves once enough have arrived, or once the
+    # first of them has waited long enough
+    async def buffer_presence(self):
+        pending = len(self.presence_added) + len(self.presence_removed)
+        if pending >= PRESENCE_MAX_EVENTS:
+            await self.send_presence()
+        elif pending and not self.presence_flush:
+            self.presence_flush = asyncio.create_task(self.send_presence_later())
+
+    async def send_presence_later(self):
+        await asyncio.sleep(PRESENCE_INTERVAL)
+        self.presence_flush = None
+        await self.send_presence()
+
+    async def send_presence(self):
+        if self.presence_flush:
+            self.presence_flush.cancel()
+            self.presence_flush = None
+
+        added = [
+            {"role": event["role"], "user": event["user"], "name": event["name"]}
+            for event in self.presence_added.values()
+        ]
+        removed = list(self.presence_removed)
+        self.presence_added = {}
+        self.presence_removed = set()
+        if not added and not removed:
+            return
+
+        # Everyone in the registry except the host itself
+        count = max(await self.registry.count() - 1, 0)
+        await self.send_json(
+            {
+                "type": "server_presence",
+                "added": added,
+                "removed": removed,
+                "count": count,
+            }
+        )
 
     # Redis database
 
@@ -276,20 +928,21 @@ class OmniConsumer(AsyncJsonWebsocketConsumer):
         index: int = self.channel_layer.consistent_hash(self.host_group)
         return self.channel_layer.connection(index)
 
-    async def redis_get(self, key, default=None):
-        group_key = f"{self.host_group}:{key}"
-        value = await self.redis.get(group_key)
-        if value is None:
-            return default
-        return json.loads(value)
+    @property
+    def counters(self) -> SessionCounters:
+        return SessionCounters(self.channel_layer)
 
-    async def redis_set(self, key, value, expire_seconds=43200):
-        group_key = f"{self.host_group}:{key}"
-        await self.redis.set(group_key, json.dumps(value), expire_seconds)
+    @property
+    def history(self) -> SessionHistory:
+        return SessionHistory(self.channel_layer, self.host_group, self.history_size)
+
+    @property
+    def session_state(self) -> SessionState:
+        return SessionState(self.channel_layer, self.host_group)
 
-    async def redis_delete(self, key):
-        group_key = f"{self.host_group}:{key}"
-        await self.redis.delete(group_key)
+    @property
+    def registry(self) -> UserRegistry:
+        return UserRegistry(self.channel_layer, self.host_group)
 
     async def redis_get_group(self, group):
         key = self.channel_layer._group_key(group)
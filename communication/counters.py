@@ -0,0 +1,108 @@
+from django.conf import settings
+from .store import session_store
+from .tasks import run_periodically
+
+# Seconds between writes of changed guest counts to the session store
+FLUSH_INTERVAL = getattr(settings, "OMNI_COUNTS_FLUSH_INTERVAL", 5)
+
+# Hashes of the number of connected guests and clients per session code, and
+# the set of codes whose guest count changed since the last flush
+GUEST_COUNTS = "omni:counts:guest"
+CLIENT_COUNTS = "omni:counts:client"
+CHANGED = "omni:counts:changed"
+
+# Change a count, unless it would exceed the limit, and mark guest counts as
+# changed. A negative limit means no limit. Decrements of counts deleted with
+# their session are ignored.
+ADD = """
+local amount = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+if amount < 0 and redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+if limit >= 0 then
+    local count = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+    if count + amount > limit then
+        return -1
+    end
+end
+local count = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+if KEYS[2] then
+    redis.call('SADD', KEYS[2], ARGV[1])
+end
+return count
+"""
+
+# Pop a batch of changed codes, returning them paired with their guest counts
+TAKE_CHANGED = """
+local codes = redis.call('SPOP', KEYS[1], ARGV[1])
+if #codes == 0 then
+    return {}
+end
+local counts = redis.call('HMGET', KEYS[2], unpack(codes))
+local result = {}
+for i, code in ipairs(codes) do
+    result[#result + 1] = code
+    result[#result + 1] = counts[i] or '0'
+end
+return result
+"""
+
+
+# Live counts of the guests and clients in each session, kept in Redis and
+# written behind to the session store
+class SessionCounters:
+    def __init__(self, channel_layer):
+        # Counts of every session live on the first shard, like the store
+        self.redis = channel_layer.connection(0)
+
+    # Change a count, returning the new count, or None if it would exceed limit
+    async def add(self, code, role, amount, limit=None):
+        if role == "guest":
+            keys = [GUEST_COUNTS, CHANGED]
+        else:
+            keys = [CLIENT_COUNTS]
+        if limit is None:
+            limit = -1
+        count = await self.redis.eval(ADD, len(keys), *keys, code, amount, limit)
+        return None if count < 0 else count
+
+    async def get(self, code):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(GUEST_COUNTS, code)
+        pipe.hget(CLIENT_COUNTS, code)
+        guests, clients = await pipe.execute()
+        return {"guests": int(guests or 0), "clients": int(clients or 0)}
+
+    async def delete(self, code):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hdel(GUEST_COUNTS, code)
+        pipe.hdel(CLIENT_COUNTS, code)
+        pipe.srem(CHANGED, code)
+        await pipe.execute()
+
+    # Guest counts of up to `batch` sessions that changed since the last call
+    async def take_changed(self, batch):
+        result = await self.redis.eval(TAKE_CHANGED, 2, CHANGED, GUEST_COUNTS, batch)
+        return {
+            code.decode(): int(count) for code, count in zip(result[::2], result[1::2])
+        }
+
+
+def flush_periodically(channel_layer):
+    run_periodically(
+        "counts_flush",
+        FLUSH_INTERVAL,
+        lambda: flush_guest_counts(channel_layer),
+        channel_layer,
+    )
+
+
+# Write changed guest counts to the session store in batches
+async def flush_guest_counts(channel_layer, batch=1000):
+    counters = SessionCounters(channel_layer)
+    while True:
+        counts = await counters.take_changed(batch)
+        if not counts:
+            return
+        await session_store.save_guest_counts(counts)
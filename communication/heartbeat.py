@@ -0,0 +1,131 @@
+import asyncio, json, time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from redis import RedisError
+from .counters import SessionCounters
+from .registry import UserRegistry
+from .tasks import run_periodically
+from .teardown import schedule_teardown
+
+
+# A duration setting in seconds, which may be None to disable what it times
+def seconds_setting(name, default, optional=False):
+    value = getattr(settings, name, default)
+    if value is None and optional:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        expected = "a positive number of seconds" + (" or None" if optional else "")
+        raise ImproperlyConfigured(f"{name} must be {expected}, not {value!r}")
+    return value
+
+
+# Seconds between pings to quiet connections, and seconds without hearing
+# from a connection before it is closed. Either is disabled by None.
+PING_INTERVAL = seconds_setting("OMNI_PING_INTERVAL", 20, optional=True)
+IDLE_TIMEOUT = seconds_setting("OMNI_IDLE_TIMEOUT", None, optional=True)
+
+# Seconds between workers vouching for their channels, and seconds without
+# being vouched for before a channel's worker is considered gone
+ALIVE_INTERVAL = seconds_setting("OMNI_ALIVE_INTERVAL", 20)
+ALIVE_TIMEOUT = seconds_setting("OMNI_ALIVE_TIMEOUT", 80)
+if ALIVE_TIMEOUT <= ALIVE_INTERVAL:
+    raise ImproperlyConfigured("OMNI_ALIVE_TIMEOUT must exceed OMNI_ALIVE_INTERVAL")
+
+# Seconds between sweeps for channels of workers that stopped without cleaning up
+REAP_INTERVAL = seconds_setting("OMNI_REAP_INTERVAL", 60)
+
+# Sorted set of authorized channels, scored by when their worker last vouched
+# for them, and a hash of what each channel joined
+ALIVE_KEY = "omni:alive"
+CHANNELS_KEY = "omni:alive:channels"
+
+
+# Authorized channels of this process. Their worker refreshes them all at once,
+# so a channel only goes stale when its worker is gone.
+class Heartbeats:
+    def __init__(self):
+        self.channels = set()
+        self.refreshers = {}
+
+    async def register(self, channel_layer, channel, info):
+        pipe = channel_layer.connection(0).pipeline(transaction=False)
+        pipe.hset(CHANNELS_KEY, channel, json.dumps(info))
+        pipe.zadd(ALIVE_KEY, {channel: time.time()})
+        await pipe.execute()
+        self.channels.add(channel)
+
+        loop = asyncio.get_running_loop()
+        if loop not in self.refreshers:
+            self.refreshers[loop] = loop.create_task(self.refresh(channel_layer))
+
+    async def unregister(self, channel_layer, channel):
+        self.channels.discard(channel)
+        pipe = channel_layer.connection(0).pipeline(transaction=False)
+        pipe.zrem(ALIVE_KEY, channel)
+        pipe.hdel(CHANNELS_KEY, channel)
+        await pipe.execute()
+
+    async def refresh(self, channel_layer):
+        while True:
+            await asyncio.sleep(ALIVE_INTERVAL)
+            if not self.channels:
+                continue
+            now = time.time()
+            try:
+                await channel_layer.connection(0).zadd(
+                    ALIVE_KEY, {channel: now for channel in self.channels}
+                )
+            except (RedisError, OSError) as error:
+                print(f"! Unable to refresh channels: {error}")
+
+
+heartbeats = Heartbeats()
+
+
+# Remove channels whose worker stopped vouching for them from their groups and
+# session, as their consumers would have on disconnect
+async def reap_dead_channels(channel_layer):
+    redis = channel_layer.connection(0)
+    deadline = time.time() - ALIVE_TIMEOUT
+    channels = await redis.zrangebyscore(ALIVE_KEY, 0, deadline)
+    for channel in channels:
+        # Only the worker removing the channel reaps it
+        if not await redis.zrem(ALIVE_KEY, channel):
+            continue
+        info = await redis.hget(CHANNELS_KEY, channel)
+        await redis.hdel(CHANNELS_KEY, channel)
+        if info:
+            await reap_channel(channel_layer, channel.decode(), json.loads(info))
+
+
+# Channels without a user stand for a number of spectators, who are counted
+# but never announced
+async def reap_channel(channel_layer, channel, info):
+    for group in info["groups"]:
+        await channel_layer.group_discard(group, channel)
+    if "user" in info:
+        await UserRegistry(channel_layer, info["host_group"]).remove(info["user"])
+
+    if info["role"] == "host":
+        # The session ends as if the host had disconnected
+        await schedule_teardown(channel_layer, info["code"], info.get("grace") or 0)
+    else:
+        amount = -info.get("count", 1)
+        await SessionCounters(channel_layer).add(info["code"], info["role"], amount)
+
+    if "user" in info:
+        await channel_layer.group_send(
+            info["other_group"],
+            {"type": "on_leave", "role": info["role"], "user": info["user"]},
+        )
+    user = info.get("user", f"{info.get('count', 0)} spectators")
+    print(f"- Reaped {info['role']} {user} of session {info['code']}")
+
+
+def reap_periodically(channel_layer):
+    run_periodically(
+        "reap_channels",
+        REAP_INTERVAL,
+        lambda: reap_dead_channels(channel_layer),
+        channel_layer,
+    )
@@ -0,0 +1,48 @@
+import time
+from django.conf import settings
+from channels_redis.core import RedisChannelLayer
+
+# Seconds a broadcast stays in a session's history
+HISTORY_MAX_AGE = getattr(settings, "OMNI_HISTORY_MAX_AGE", 60)
+
+
+# Recent broadcasts of a session's host, kept in a capped Redis Stream next to
+# the session's user registry, so clients can resume after a dropped connection.
+# Stream ids double as the offsets of the messages.
+class SessionHistory:
+    def __init__(self, channel_layer: RedisChannelLayer, host_group, size):
+        self.key = self.history_key(host_group)
+        self.size = size
+        index = channel_layer.consistent_hash(host_group)
+        self.redis = channel_layer.connection(index)
+
+    @staticmethod
+    def history_key(host_group):
+        return f"{host_group}:history"
+
+    # Append an encoded message, returning its offset
+    async def append(self, text):
+        min_id = int((time.time() - HISTORY_MAX_AGE) * 1000)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xadd(self.key, {"text": text}, maxlen=self.size, approximate=True)
+        pipe.xtrim(self.key, minid=min_id, approximate=True)
+        pipe.expire(self.key, HISTORY_MAX_AGE)
+        offset, *_ = await pipe.execute()
+        return offset.decode()
+
+    async def oldest(self):
+        entries = await self.redis.xrange(self.key, count=1)
+        return entries[0][0].decode() if entries else None
+
+    # Messages after an offset, oldest first, as (offset, text) pairs
+    async def read_after(self, offset, count):
+        entries = await self.redis.xrange(self.key, min=f"({offset}", count=count)
+        return [
+            (offset.decode(), fields[b"text"].decode()) for offset, fields in entries
+        ]
+
+
+# Order of two offsets, as stream ids are compared
+def offset_key(offset):
+    milliseconds, _, sequence = str(offset).partition("-")
+    return int(milliseconds), int(sequence or 0)
@@ -0,0 +1,257 @@
+import asyncio
+from collections import Counter, defaultdict
+from channels_redis.core import RedisChannelLayer
+
+# What happens to messages for a local channel over its backlog limit
+DROP_OLDEST = "drop_oldest"
+LATEST = "latest"
+DISCONNECT = "disconnect"
+
+
+# Redis channel layer that hands messages for consumers in this process
+# straight to their receive buffers, only going through Redis for the rest
+class LocalFanoutChannelLayer(RedisChannelLayer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Channels created by this process, and the event loop receiving them
+        self.local_channels = {}
+        # Members of each group that live in this process
+        self.local_groups = defaultdict(set)
+        # Task moving messages from this process' Redis queue into the buffers
+        self.reader = None
+        # Backlog limit and policy of local channels, the number of messages
+        # each has dropped, and channels that are told to disconnect
+        self.backlog_limits = {}
+        self.dropped = Counter()
+        self.lagging = set()
+        # Topics that local channels subscribed to, for those that did
+        self.subscriptions = {}
+
+    @property
+    def process_channel(self):
+        return f"specific.{self.client_prefix}!"
+
+    def is_local(self, channel):
+        return channel.startswith(self.process_channel)
+
+    # Deliver a message in memory, returning False if it has to go through Redis
+    def deliver_local(self, channel, message):
+        if not self.is_local(channel):
+            return False
+
+        # Messages for channels that have stopped receiving are dropped, as
+        # nobody in this process will ever read them
+        loop = self.local_channels.get(channel)
+        if loop is None:
+            return True
+
+        # Buffers can only be touched from the loop that is receiving them
+        if loop is not asyncio.get_running_loop():
+            return False
+
+        self.enqueue(channel, message)
+        return True
+
+    async def new_channel(self, prefix="specific"):
+        channel = await super().new_channel(prefix)
+        if self.is_local(channel):
+            self.local_channels[channel] = asyncio.get_running_loop()
+        return channel
+
+    def forget_channel(self, channel):
+        self.local_channels.pop(channel, None)
+        self.receive_buffer.pop(channel, None)
+        self.backlog_limits.pop(channel, None)
+        self.dropped.pop(channel, None)
+        self.lagging.discard(channel)
+        self.subscriptions.pop(channel, None)
+        for group, members in list(self.local_groups.items()):
+            if channel in members:
+                self.group_discard_local(group, channel)
+
+    # Receiving
+
+    async def receive(self, channel):
+        if not self.is_local(channel):
+            return await super().receive(channel)
+
+        self.start_reader()
+        try:
+            return await self.receive_buffer[channel].get()
+        except asyncio.CancelledError:
+            # Consumers only cancel their receive when they exit
+            self.forget_channel(channel)
+            raise
+
+    def start_reader(self):
+        loop = asyncio.get_running_loop()
+        if self.reader is None or self.reader.done():
+            self.reader = loop.create_task(self.read_process_channel())
+        elif self.reader.get_loop() is not loop:
+            raise RuntimeError(
+                "Two event loops are trying to receive() on one channel layer at once!"
+            )
+
+    # A single reader per process waits on Redis, so consumers only ever wait
+    # on their own buffer and see local deliveries immediately
+    async def read_process_channel(self):
+        while True:
+            try:
+                channels, message = await self.receive_single(self.process_channel)
+            except Exception as error:
+                print(f"! Unable to read channel layer: {error!r}")
+                await asyncio.sleep(1)
+                continue
+
+            if not isinstance(channels, list):
+                channels = [channels]
+            for channel in channels:
+                if channel in self.local_channels:
+                    self.enqueue(channel, message)
+
+    # Backpressure
+
+    # Limit the number of messages waiting for a local channel's consumer. The
+    # limit is capped at the layer's capacity, beyond which the receive buffer
+    # would drop the oldest message whatever the policy.
+    def set_backlog_limit(self, channel, limit, policy=DROP_OLDEST):
+        limit = min(limit, self.get_capacity(channel))
+        self.backlog_limits[channel] = (limit, policy)
+
+    def backlog(self, channel):
+        buffer = self.receive_buffer.get(channel)
+        return buffer.qsize() if buffer else 0
+
+    def enqueue(self, channel, message):
+        # Nothing more is delivered to channels that are about to disconnect,
+        # or that aren't interested in the message
+        if channel in self.lagging or not self.subscribed(channel, message):
+            return
+
+        buffer = self.receive_buffer[channel]
+        limit, policy = self.backlog_limits.get(channel, (None, None))
+        if limit is None or buffer.qsize() < limit:
+            return buffer.put_nowait(message)
+
+        self.dropped[channel] += 1
+
+        if policy == DISCONNECT:
+            self.lagging.add(channel)
+            while not buffer.empty():
+                buffer.get_nowait()
+            return buffer.put_nowait({"type": "on_backlog_exceeded"})
+
+        # Drop the oldest message replaced by this one, or else the oldest one
+        queued = [buffer.get_nowait() for _ in range(buffer.qsize())]
+        index = 0
+        if policy == LATEST:
+            key = self.backlog_key(message)
+            for i, queued_message in enumerate(queued):
+                if self.backlog_key(queued_message) == key:
+                    index = i
+                    break
+        del queued[index]
+        for queued_message in queued + [message]:
+            buffer.put_nowait(queued_message)
+
+    # Messages replace each other when they share an event type and topic.
+    # Targeted messages aren't filtered by topic, and carry a "key" instead,
+    # which is a list of topics for a batch.
+    @staticmethod
+    def backlog_key(message):
+        key = message.get("key", message.get("topic"))
+        if isinstance(key, list):
+            key = tuple(key)
+        return message.get("type"), key
+
+    # Topics
+
+    # Only deliver messages on the given topics to a local channel, as well as
+    # messages without a topic. Topics of server messages can't be filtered.
+    def subscribe(self, channel, topics):
+        self.subscriptions.setdefault(channel, set()).update(topics)
+
+    # Stop delivering messages on the given topics, or filtering at all
+    def unsubscribe(self, channel, topics=None):
+        if topics is None:
+            self.subscriptions.pop(channel, None)
+        elif channel in self.subscriptions:
+            self.subscriptions[channel].difference_update(topics)
+
+    def subscribed(self, channel, message):
+        topics = self.subscriptions.get(channel)
+        if topics is None:
+            return True
+        topic = message.get("topic")
+        return topic is None or topic in topics or str(topic).startswith("server_")
+
+    # Sending
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        if not self.deliver_local(channel, message):
+            await super().send(channel, message)
+
+    # Groups
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        if channel in self.local_channels:
+            self.local_groups[group].add(channel)
+
+    async def group_discard(self, group, channel):
+        self.group_discard_local(group, channel)
+        await super().group_discard(group, channel)
+
+    def group_discard_local(self, group, channel):
+        members = self.local_groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.local_groups[group]
+
+    # Delete whole groups at once, returning how many members each one had
+    async def group_delete(self, *groups):
+        shards = defaultdict(list)
+        for group in groups:
+            self.local_groups.pop(group, None)
+            shards[self.consistent_hash(group)].append(group)
+
+        members = {}
+        for index, shard_groups in shards.items():
+            pipe = self.connection(index).pipeline(transaction=False)
+            for group in shard_groups:
+                pipe.zcard(self._group_key(group))
+                pipe.delete(self._group_key(group))
+            results = await pipe.execute()
+            members.update(zip(shard_groups, results[::2]))
+        return members
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+
+        # Members in this process receive the message before anything is
+        # awaited, keeping it ordered with the sender's other local messages
+        for channel in list(self.local_groups.get(group, ())):
+            self.deliver_local(channel, message)
+
+        # Members in other processes receive it through Redis
+        await super().group_send(group, message)
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        # Only called by group_send, which has already served the local members
+        # receiving on this event loop and dropped those that have exited
+        loop = asyncio.get_running_loop()
+        remote_names = [
+            channel
+            for channel in channel_names
+            if not self.is_local(channel)
+            or self.local_channels.get(channel, loop) is not loop
+        ]
+        return super()._map_channel_keys_to_connection(remote_names, message)
+
+    async def close_pools(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        await super().close_pools()
@@ -0,0 +1,165 @@
+import asyncio, contextlib, io, json, msgpack, statistics, time, uuid
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from channels.testing import WebsocketCommunicator
+from communication.cache import token_cache
+from communication.consumers import OmniConsumer
+from communication.store import session_store
+
+from communication.models import Service
+
+
+class Command(BaseCommand):
+    help = "Benchmark the websocket consumer against the configured database and channel layer"
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+        connect = subparsers.add_parser("connect", help="Connects per second")
+        connect.add_argument(
+            "--role", choices=["host", "client", "guest"], default="guest"
+        )
+        connect.add_argument("--connects", type=int, default=500)
+        connect.add_argument("--concurrency", type=int, default=50)
+        connect.add_argument(
+            "--cold",
+            action="store_true",
+            help="Clear the token cache before every connect",
+        )
+
+        broadcast = subparsers.add_parser(
+            "broadcast", help="CPU time of fanning a host message out to guests"
+        )
+        broadcast.add_argument("--guests", type=int, default=1000)
+        broadcast.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        benchmark = getattr(self, f"benchmark_{options['benchmark']}")
+
+        # Silence the consumer's connection log unless asked for it
+        if options["verbosity"] > 1:
+            benchmark(**options)
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                benchmark(**options)
+
+    # Connects
+
+    def benchmark_connect(self, role, connects, concurrency, cold, **options):
+        service = Service.objects.create(
+            title=f"benchmark-{uuid.uuid4().hex[:8]}", allow_public_code=True
+        )
+        session = async_to_sync(session_store.create)(service)
+        token = {
+            "host": str(service.host_token),
+            "client": str(service.client_token),
+            "guest": session.code,
+        }[role]
+
+        latencies = []
+        start = time.perf_counter()
+        try:
+            async_to_sync(self.run_connects)(
+                token, connects, concurrency, cold, latencies
+            )
+        finally:
+            async_to_sync(session_store.delete)(session.code)
+            service.delete()
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f"{connects} {role} connects in {elapsed:.2f} s "
+            f"({connects / elapsed:.1f} connects/s, concurrency {concurrency})"
+        )
+        self.stdout.write(
+            f"Authorization latency: median {statistics.median(latencies) * 1000:.1f} ms, "
+            f"p95 {statistics.quantiles(latencies, n=20)[-1] * 1000:.1f} ms"
+        )
+
+    async def run_connects(self, token, connects, concurrency, cold, latencies):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run():
+            async with semaphore:
+                if cold:
+                    token_cache.clear()
+                latencies.append(await self.connect(token))
+
+        await asyncio.gather(*(run() for _ in range(connects)))
+
+    async def connect(self, token):
+        communicator = WebsocketCommunicator(OmniConsumer.as_asgi(), "/ws/")
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        start = time.perf_counter()
+        await communicator.send_json_to({"token": token})
+        while True:
+            message = await communicator.receive_json_from(timeout=10)
+            if message["type"] == "server_authorized":
+                break
+            if message["type"] == "server_error":
+                raise RuntimeError(json.dumps(message))
+        latency = time.perf_counter() - start
+
+        await communicator.disconnect()
+        return latency
+
+    # Broadcasts
+
+    def benchmark_broadcast(self, guests, repeat, **options):
+        async_to_sync(self.run_broadcasts)(guests, repeat)
+
+    async def run_broadcasts(self, guests, repeat):
+        # A typical host state update
+        content = {
+            "type": "state",
+            "players": [
+                {"id": f"p{i}", "x": i * 0.5, "y": i * 0.25, "score": i * 10}
+                for i in range(20)
+            ],
+        }
+
+        async def discard(message):
+            pass
+
+        consumers = [OmniConsumer() for _ in range(guests)]
+        for consumer in consumers:
+            consumer.base_send = discard
+
+        # Each receiver encodes the message itself. Both paths also pack the
+        # event once with msgpack, as the channel layer does for each process.
+        async def per_receiver():
+            event = {"type": "on_send", "data": content}
+            msgpack.packb(event, use_bin_type=True)
+            for consumer in consumers:
+                await consumer.on_send(event)
+
+        # The sender encodes the message once
+        async def encode_once():
+            event = {
+                "type": "on_send_text",
+                "text": await OmniConsumer.encode_json(content),
+            }
+            msgpack.packb(event, use_bin_type=True)
+            for consumer in consumers:
+                await consumer.on_send_text(event)
+
+        results = {}
+        for name, fan_out in [
+            ("Per-receiver encoding", per_receiver),
+            ("Encode once", encode_once),
+        ]:
+            start = time.process_time()
+            for _ in range(repeat):
+                await fan_out()
+            results[name] = (time.process_time() - start) / repeat
+            self.stdout.write(
+                f"{name}: {results[name] * 1000:.2f} ms CPU per {guests}-guest fan-out"
+            )
+
+        saved = results["Per-receiver encoding"] - results["Encode once"]
+        self.stdout.write(
+            f"Saved {saved * 1000:.2f} ms CPU per fan-out "
+            f"({saved / results['Per-receiver encoding'] * 100:.0f}%)"
+        )
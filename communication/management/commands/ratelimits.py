@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from communication.cache import get_publisher
+from communication.ratelimit import DROPS_KEY
+
+from communication.models import Service
+
+
+class Command(BaseCommand):
+    help = "Show the number of messages dropped by rate limits, per service and role"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reset", action="store_true", help="Reset the counts after showing them"
+        )
+
+    def handle(self, *args, **options):
+        redis = get_publisher()
+        drops = redis.hgetall(DROPS_KEY)
+        if options["reset"]:
+            redis.delete(DROPS_KEY)
+
+        if not drops:
+            self.stdout.write("No messages dropped")
+            return
+
+        titles = dict(Service.objects.values_list("host_token", "title"))
+        titles = {str(token): title for token, title in titles.items()}
+        for field, count in sorted(drops.items(), key=lambda item: -int(item[1])):
+            service, role = field.decode().rsplit(":", 1)
+            self.stdout.write(
+                f"{titles.get(service, service)} ({role}): {int(count)} dropped"
+            )
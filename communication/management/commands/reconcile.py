@@ -0,0 +1,28 @@
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from channels.layers import get_channel_layer
+from communication.reconcile import RECONCILE_BATCH, reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete sessions without a live host, and Redis keys of sessions that are gone"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count what would be deleted",
+        )
+        parser.add_argument("--batch", type=int, default=RECONCILE_BATCH)
+
+    def handle(self, *args, **options):
+        result = async_to_sync(reconcile)(
+            get_channel_layer(), options["batch"], options["dry_run"]
+        )
+        verb = "Found" if options["dry_run"] else "Deleted"
+        self.stdout.write(
+            f"{verb} {result['orphaned']} orphaned sessions and {result['keys']} "
+            f"stray keys, kept {result['sessions']} sessions"
+        )
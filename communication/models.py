@@ -1,13 +1,14 @@
-import random, re, uuid
+import re, uuid
+from django.core.validators import MinValueValidator
 from django.db import models
+from .codes import random_code
+from .layers import DISCONNECT, DROP_OLDEST, LATEST
 
 
+# Fallback for when the code pool is unavailable
 def generate_code():
-    chars = list("ABCDEFGHIJKLMNOPQRSTUVXYZ")
-    size = 4
     while True:
-        random.shuffle(chars)
-        code = "".join(chars[:size])
+        code = random_code()
         if not Session.objects.filter(code=code).exists():
             return code
 
@@ -52,13 +53,104 @@ class Service(models.Model):
         help_text="If enabled, the service will be accessible through a public code or link. A new code is generated everytime the host connects.",
     )
 
-    # TODO: Add a field for the host to set the number of guests allowed
+    # Boolean for relaying messages without parsing them
+    raw_relay = models.BooleanField(
+        default=False,
+        help_text='If enabled, messages are forwarded as raw text instead of being decoded and re-encoded. Messages from clients and guests are delivered to the host as {"user": <USER_ID>, "data": <MESSAGE>}.',
+    )
+
+    # Boolean for checking raw relay messages
+    validate_json = models.BooleanField(
+        default=True,
+        help_text="If disabled, host messages in raw relay mode are forwarded without checking that they are valid JSON. Messages from clients and guests are always checked.",
+    )
+
+    # Boolean for batching join and leave announcements
+    coalesce_presence = models.BooleanField(
+        default=False,
+        help_text="If enabled, the host receives joins and leaves in batches as a single server_presence message, instead of one message per user. Useful for sessions where many guests join at once.",
+    )
+
+    # Seconds a session waits for its host to return
+    host_grace_period = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Seconds a session stays open after the host disconnects. Guests and clients are told the host is away, and a host reconnecting in time resumes the session with the same code. Leave empty to end the session as soon as the host disconnects.",
+    )
+
+    # Number of guests allowed in a session
+    max_guests = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="The number of guests allowed in a session at once. Guests joining a full session are rejected. Set to 0 to allow no guests, or leave empty for no limit.",
+    )
+
+    # Rate limits on messages sent by clients and guests
+    client_rate_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        help_text="Messages per second each client may send. Leave empty for no limit.",
+    )
+
+    guest_rate_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        help_text="Messages per second each guest may send. Leave empty for no limit.",
+    )
+
+    service_rate_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        help_text="Messages per second all clients and guests of the service may send together. Leave empty for no limit.",
+    )
+
+    RATE_LIMIT_DROP = "drop"
+    RATE_LIMIT_CLOSE = "close"
+    rate_limit_policy = models.CharField(
+        max_length=8,
+        choices=[
+            (RATE_LIMIT_DROP, "Drop messages"),
+            (RATE_LIMIT_CLOSE, "Close connection"),
+        ],
+        default=RATE_LIMIT_DROP,
+        help_text="What happens to messages over a rate limit. Either they are dropped, or the connection sending them is closed.",
+    )
+
+    # Number of host messages kept for clients resuming a connection
+    history_size = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="The number of recent messages from the host kept for clients and guests resuming a dropped connection. Messages are kept for a minute at most. Leave empty to keep no history.",
+    )
+
+    # Handling of clients and guests too slow to receive messages
+    backlog_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="The number of messages that may wait for a client or guest that is falling behind, up to the channel layer's capacity. Leave empty for the server default.",
+    )
+
+    backlog_policy = models.CharField(
+        max_length=16,
+        choices=[
+            (DROP_OLDEST, "Drop oldest messages"),
+            (LATEST, "Keep only the latest message of each type"),
+            (DISCONNECT, "Disconnect"),
+        ],
+        default=DROP_OLDEST,
+        help_text="What happens when a client or guest has more messages waiting than the backlog limit.",
+    )
 
     # TODO: Add a field for only allowing certain dns or ip addresses
 
-    def add_session(self):
+    def add_session(self, code=None):
         group_key = safe_string(self.title)
-        session = Session(service=self, group_key=group_key)
+        session = Session(
+            service=self, group_key=group_key, code=code or generate_code()
+        )
         session.save()
         return session
 
@@ -87,6 +179,7 @@ class Session(models.Model):
     code = models.CharField(
         max_length=8,
         null=True,
+        unique=True,
         default=generate_code,
         help_text="The public code for guests to connect via. A new code is generated everytime the host connects to a service.",
     )
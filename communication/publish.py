@@ -0,0 +1,117 @@
+import asyncio, json, uuid
+from collections import defaultdict
+from django.conf import settings
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from .consumers import OmniConsumer
+from .history import SessionHistory
+from .registry import UserRegistry
+from .resolver import cached_service
+from .store import session_store
+from .utils import is_uuid
+
+# Most messages accepted in one request
+PUBLISH_MAX_MESSAGES = getattr(settings, "OMNI_PUBLISH_MAX_MESSAGES", 1000)
+
+# Groups of a session that a published message can be addressed to
+GROUPS = {"clients": "client_group", "guests": "guest_group", "host": "host_group"}
+
+
+# Deliver messages from backend systems as if their host had sent them. Each
+# message carries the host token of its service, and goes to the service's
+# current session. Messages for one session arrive in order, while sessions
+# are delivered to concurrently. Returns a result for every message.
+async def publish(messages):
+    channel_layer = get_channel_layer()
+    results = [None] * len(messages)
+
+    by_token = defaultdict(list)
+    for index, message in enumerate(messages):
+        error = validate(message)
+        if error:
+            results[index] = {"ok": False, "error": error}
+        else:
+            by_token[str(message["token"])].append(index)
+
+    async def publish_to_service(token, indexes):
+        service, session, error = await find_session(token)
+        for index in indexes:
+            if error:
+                results[index] = {"ok": False, "error": error}
+            else:
+                results[index] = await deliver(
+                    channel_layer, service, session, messages[index]
+                )
+
+    await asyncio.gather(
+        *(publish_to_service(token, indexes) for token, indexes in by_token.items())
+    )
+    return results
+
+
+def validate(message):
+    if not isinstance(message, dict):
+        return "Malformed message. Expected an object."
+    if not message.get("token"):
+        return 'Missing "token"'
+    if not isinstance(message.get("data"), dict):
+        return 'Malformed data. Expected "data" to be an object.'
+    if message.get("group", "clients") not in GROUPS:
+        return f'Unknown group. Expected one of {", ".join(GROUPS)}.'
+
+
+async def find_session(token):
+    service = await cached_service(token) if is_uuid(token) else None
+    if not service or service.host_token != uuid.UUID(token):
+        return None, None, "Invalid token"
+
+    session = await session_store.current(service)
+    if not session:
+        return service, None, "No open session"
+    return service, session, None
+
+
+async def deliver(channel_layer, service, session, message):
+    users = OmniConsumer.target_users(message)
+    if users is not None:
+        return await deliver_to_users(channel_layer, session, users, message["data"])
+
+    group = message.get("group", "clients")
+    data = message["data"]
+    event = {"type": "on_send_text", "topic": OmniConsumer.message_topic(data)}
+
+    # Broadcasts to everyone are kept for clients resuming a dropped connection
+    if group == "clients" and service.history_size:
+        history = SessionHistory(
+            channel_layer, session.host_group, service.history_size
+        )
+        event["offset"] = await history.append(json.dumps(data))
+        data = {**data, "offset": event["offset"]}
+
+    event["text"] = json.dumps(data)
+    await channel_layer.group_send(getattr(session, GROUPS[group]), event)
+    return {"ok": True, "session": session.code}
+
+
+async def deliver_to_users(channel_layer, session, users, data):
+    channels = await UserRegistry(channel_layer, session.host_group).get_many(users)
+    event = {"type": "on_send", "data": data, "key": OmniConsumer.message_topic(data)}
+    sent = await asyncio.gather(
+        *(send(channel_layer, channel, event) for channel in channels.values())
+    )
+    return {
+        "ok": True,
+        "session": session.code,
+        "delivered": [user for user, ok in zip(channels, sent) if ok],
+        "lagging": [user for user, ok in zip(channels, sent) if not ok],
+        "missing": [user for user in users if user not in channels],
+    }
+
+
+# Send to a channel, returning False if its worker's queue is full
+async def send(channel_layer, channel, event):
+    try:
+        await channel_layer.send(channel, event)
+        return True
+    except ChannelFull:
+        return False
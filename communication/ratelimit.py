@@ -0,0 +1,89 @@
+import asyncio, time
+from collections import Counter
+from redis import RedisError
+
+# Hash of the number of messages dropped per service and role
+DROPS_KEY = "omni:ratelimit:drops"
+
+# Token bucket shared by every worker, refilled from the Redis clock. Takes up
+# to the requested number of tokens, returning how many were granted.
+TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local wanted = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local granted = math.min(wanted, math.floor(tokens))
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - granted), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return granted
+"""
+
+
+# Allows `rate` messages per second on average, and bursts of up to `burst`
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# Budget of messages per second shared by all connections of a service across
+# workers. Each worker leases a tenth of a second's worth of tokens at a time
+# from Redis, so most messages are checked without a round trip.
+class ServiceBudget:
+    def __init__(self):
+        self.leases = Counter()
+        self.dropped = Counter()
+        self.flushing = None
+
+    async def take(self, redis, service, rate):
+        if self.leases[service] < 1:
+            key = f"omni:ratelimit:{service}"
+            lease = max(int(rate / 10), 1)
+            try:
+                granted = await redis.eval(TAKE, 1, key, rate, rate, lease)
+            except (RedisError, OSError) as error:
+                # Connections are rather left unlimited than cut off
+                print(f"! Unable to check rate limit of {service}: {error}")
+                return True
+            self.leases[service] += granted
+            if self.leases[service] < 1:
+                return False
+        self.leases[service] -= 1
+        return True
+
+    # Count dropped messages, writing the counts to Redis at most every second
+    def record_drop(self, redis, service, role):
+        self.dropped[f"{service}:{role}"] += 1
+        if not self.flushing:
+            self.flushing = asyncio.create_task(self.flush_drops(redis))
+
+    async def flush_drops(self, redis):
+        await asyncio.sleep(1)
+        dropped, self.dropped = self.dropped, Counter()
+        self.flushing = None
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for field, count in dropped.items():
+                pipe.hincrby(DROPS_KEY, field, count)
+            await pipe.execute()
+        except (RedisError, OSError) as error:
+            print(f"! Unable to record dropped messages: {error}")
+
+
+service_budget = ServiceBudget()
@@ -0,0 +1,149 @@
+import asyncio, json, time
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .heartbeat import ALIVE_INTERVAL, ALIVE_KEY, ALIVE_TIMEOUT, CHANNELS_KEY
+from .store import session_store
+from .tasks import run_periodically
+from .teardown import TEARDOWNS_KEY, teardown_session
+
+# Seconds between reconciliations, and the number of sessions or Redis keys
+# handled per query or pipeline
+RECONCILE_INTERVAL = getattr(settings, "OMNI_RECONCILE_INTERVAL", 3600)
+RECONCILE_BATCH = getattr(settings, "OMNI_RECONCILE_BATCH", 500)
+
+# Sessions are only reconciled once their host has had time to register
+MIN_AGE = timedelta(seconds=ALIVE_TIMEOUT)
+
+# Prefixes of the groups of a session, and so of the keys stored alongside them
+GROUP_PREFIXES = ("host_", "client_", "guest_")
+
+
+# Delete sessions without a live host, left behind by workers that crashed or
+# were redeployed, then Redis keys of sessions that no longer exist. Keys are
+# found with SCAN and deleted with UNLINK in pipelined batches, so Redis keeps
+# serving everyone else meanwhile.
+async def reconcile(channel_layer, batch=RECONCILE_BATCH, dry_run=False):
+    live = await live_codes(channel_layer, batch)
+    cutoff = timezone.now() - MIN_AGE
+
+    # Sessions are deleted after iterating, so the iteration isn't disturbed
+    known, orphans = set(), []
+    async for sessions in session_store.iter_sessions(batch):
+        for session in sessions:
+            if session.code in live or session.created_on > cutoff:
+                known.add(session.code)
+            else:
+                orphans.append(session)
+
+    for start in range(0, len(orphans), batch):
+        if dry_run:
+            break
+        sessions = orphans[start : start + batch]
+        await session_store.delete_many([session.code for session in sessions])
+        await asyncio.gather(
+            *(clear_session(channel_layer, session) for session in sessions)
+        )
+
+    keys = await delete_stray_keys(channel_layer, known, batch, dry_run)
+    return {"sessions": len(known), "orphaned": len(orphans), "keys": keys}
+
+
+# Codes of sessions whose host is connected, or may still return
+async def live_codes(channel_layer, batch):
+    redis = channel_layer.connection(0)
+    codes = {code.decode() for code in await redis.zrange(TEARDOWNS_KEY, 0, -1)}
+
+    deadline = time.time() - ALIVE_TIMEOUT
+    cursor = 0
+    while True:
+        cursor, channels = await redis.hscan(CHANNELS_KEY, cursor, count=batch)
+        hosts = {}
+        for channel, info in channels.items():
+            info = json.loads(info)
+            if info["role"] == "host":
+                hosts[channel] = info["code"]
+        if hosts:
+            scores = await redis.zmscore(ALIVE_KEY, list(hosts))
+            codes.update(
+                code
+                for code, score in zip(hosts.values(), scores)
+                if score is not None and score >= deadline
+            )
+        if not cursor:
+            return codes
+
+
+async def clear_session(channel_layer, session):
+    await channel_layer.group_send(
+        session.guest_group,
+        {"type": "on_kick", "message": "Session ended by host", "closed": True},
+    )
+    await teardown_session(
+        channel_layer,
+        session.code,
+        session.host_group,
+        session.client_group,
+        session.guest_group,
+    )
+
+
+# Session code of a group key, or of a key stored alongside a session's groups
+def key_code(channel_layer, key):
+    group_prefix = channel_layer._group_key("").decode()
+    name = key.decode()
+    if name.startswith(group_prefix):
+        name = name[len(group_prefix) :]
+    name = name.split(":", 1)[0]
+    if name.startswith(GROUP_PREFIXES) and name.count("_") >= 2:
+        return name.rsplit("_", 1)[1]
+
+
+# Delete group sorted sets, registries, state, history and other keys of
+# sessions that no longer exist, returning how many were found
+async def delete_stray_keys(channel_layer, known, batch, dry_run):
+    patterns = [channel_layer._group_key("*"), "host_*"]
+    found = 0
+    for index in range(channel_layer.ring_size):
+        redis = channel_layer.connection(index)
+        for pattern in patterns:
+            keys = []
+            async for key in redis.scan_iter(match=pattern, count=batch):
+                code = key_code(channel_layer, key)
+                if code and code not in known:
+                    keys.append((key, code))
+                if len(keys) >= batch:
+                    found += await delete_keys(redis, keys, dry_run)
+                    keys = []
+            if keys:
+                found += await delete_keys(redis, keys, dry_run)
+    return found
+
+
+async def delete_keys(redis, keys, dry_run):
+    # Sessions created since they were iterated over keep their keys
+    existing = await session_store.existing({code for _, code in keys})
+    keys = [key for key, code in keys if code not in existing]
+    if keys and not dry_run:
+        await redis.unlink(*keys)
+    return len(keys)
+
+
+# Reconcile shortly after startup, and periodically after that
+def reconcile_periodically(channel_layer):
+    run_periodically(
+        "reconcile",
+        RECONCILE_INTERVAL,
+        lambda: report(reconcile(channel_layer)),
+        channel_layer,
+        delay=ALIVE_INTERVAL,
+    )
+
+
+async def report(reconciliation):
+    result = await reconciliation
+    if result["orphaned"] or result["keys"]:
+        print(
+            f"- Reconciled {result['orphaned']} orphaned sessions "
+            f"and {result['keys']} stray keys"
+        )
@@ -0,0 +1,49 @@
+from channels_redis.core import RedisChannelLayer
+
+# Seconds a session's registry outlives its last join
+REGISTRY_EXPIRY = 12 * 3600
+
+
+# Registry of the channel names of a session's participants, kept as one Redis
+# hash per session on the shard the channel layer uses for its host group
+class UserRegistry:
+    def __init__(self, channel_layer: RedisChannelLayer, host_group):
+        self.key = self.registry_key(host_group)
+        index = channel_layer.consistent_hash(host_group)
+        self.redis = channel_layer.connection(index)
+
+    @staticmethod
+    def registry_key(host_group):
+        return f"{host_group}:users"
+
+    async def add(self, user, channel_name):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(self.key, user, channel_name)
+        pipe.expire(self.key, REGISTRY_EXPIRY)
+        await pipe.execute()
+
+    async def get(self, user):
+        channel_name = await self.redis.hget(self.key, user)
+        return channel_name.decode() if channel_name else None
+
+    # Map users to their channel names, leaving out users that aren't found
+    async def get_many(self, users):
+        users = list(users)
+        if not users:
+            return {}
+        channel_names = await self.redis.hmget(self.key, users)
+        return {
+            user: channel_name.decode()
+            for user, channel_name in zip(users, channel_names)
+            if channel_name
+        }
+
+    async def remove(self, *users):
+        if users:
+            await self.redis.hdel(self.key, *users)
+
+    async def count(self):
+        return await self.redis.hlen(self.key)
+
+    async def clear(self):
+        await self.redis.delete(self.key)
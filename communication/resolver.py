@@ -0,0 +1,83 @@
+import uuid
+from dataclasses import dataclass
+from django.db.models import Q
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from .cache import token_cache
+from .store import session_store
+from .teardown import cancel_teardown
+from .utils import is_uuid
+
+from .models import Service, Session
+
+HOST = "host"
+CLIENT = "client"
+GUEST = "guest"
+
+
+# Outcome of resolving the token sent in a connection's first message
+@dataclass
+class Resolution:
+    role: str
+    service: Service
+    session: Session | None
+    created: bool = False
+    resumed: bool = False
+
+    @property
+    def is_host(self):
+        return self.role == HOST
+
+    @property
+    def is_guest(self):
+        return self.role == GUEST
+
+
+# Classify a token, then find or create the session it connects to
+async def resolve_token(token) -> Resolution | None:
+    if is_uuid(token):
+        service = await cached_service(token)
+        if not service:
+            return None
+
+        if service.host_token == uuid.UUID(str(token)):
+            session = None
+            if not service.allow_public_code or service.host_grace_period:
+                session = await session_store.current(service)
+
+            # Hosts returning within the grace period resume their session
+            if session and service.host_grace_period:
+                if await cancel_teardown(get_channel_layer(), session.code):
+                    return Resolution(HOST, service, session, resumed=True)
+
+            # Hosts of public services get a new code on every connect
+            if session and not service.allow_public_code:
+                return Resolution(HOST, service, session)
+
+            session = await session_store.create(service)
+            return Resolution(HOST, service, session, created=True)
+
+        # Clients may only join an existing session
+        return Resolution(CLIENT, service, await session_store.current(service))
+
+    elif isinstance(token, str):
+        # Check if token is a public code
+        session = await session_store.get_by_code(token)
+        if session and session.service.allow_public_code:
+            return Resolution(GUEST, session.service, session)
+
+
+# Cached lookups, only hitting the database on a cache miss. Misses go through
+# database_sync_to_async, which replaces stale or broken connections first.
+
+
+async def cached_service(token):
+    token = uuid.UUID(str(token))
+    return await token_cache.get_or_load(
+        ("token", str(token)),
+        database_sync_to_async(
+            lambda: Service.objects.filter(
+                Q(host_token=token) | Q(client_token=token)
+            ).first()
+        ),
+    )
@@ -1,6 +1,10 @@
 from django.urls import re_path
-from . import consumers
+from . import consumers, spectators
 
 websocket_urlpatterns = [
     re_path(r"^ws/?", consumers.OmniConsumer.as_asgi()),
 ]
+
+http_urlpatterns = [
+    re_path(r"^sse/(?P<code>[^/]+)/?$", spectators.SpectatorConsumer.as_asgi()),
+]
@@ -0,0 +1,35 @@
+from functools import partial
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .cache import token_cache, publish_invalidation
+from .codes import code_pool
+from .store import session_store
+
+from .models import Service, Session
+
+
+# Evict cached tokens whenever a service or session changes. Other workers are
+# only told once the change is committed, so they can't reload stale rows.
+def invalidate(tag):
+    token_cache.invalidate(tag)
+    transaction.on_commit(partial(publish_invalidation, tag))
+
+
+@receiver([post_save, post_delete], sender=Service)
+def service_changed(sender, instance, **kwargs):
+    invalidate(str(instance.pk))
+
+
+# Session rows are only snapshots when sessions are kept in Redis
+@receiver([post_save, post_delete], sender=Session)
+def session_changed(sender, instance, **kwargs):
+    if session_store.in_database:
+        invalidate(str(instance.service_id))
+
+
+# Return the public code of a deleted session to the pool
+@receiver(post_delete, sender=Session)
+def session_deleted(sender, instance, **kwargs):
+    if session_store.in_database:
+        transaction.on_commit(partial(code_pool.release, instance.code))
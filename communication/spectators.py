@@ -0,0 +1,224 @@
+import asyncio, json
+from urllib.parse import parse_qs
+from channels.exceptions import StopConsumer
+from channels.generic.http import AsyncHttpConsumer
+from channels.layers import get_channel_layer
+from .counters import SessionCounters
+from .heartbeat import PING_INTERVAL, heartbeats
+from .state import SessionState
+from .store import session_store
+
+# Hubs of the sessions watched in this process, per event loop
+_hubs = {}
+
+
+# Everything spectators in this process receive about a session comes through
+# one channel in the session's groups. Each event is encoded once, and the same
+# buffer is written to every spectator.
+class SpectatorHub:
+    def __init__(self, channel_layer, session):
+        self.channel_layer = channel_layer
+        self.code = session.code
+        self.host_group = session.host_group
+        self.groups = [session.client_group, session.guest_group]
+        self.spectators = set()
+        self.channel = None
+        self.tasks = []
+        self.starting = asyncio.ensure_future(self.start())
+
+    @classmethod
+    def get(cls, channel_layer, session):
+        key = asyncio.get_running_loop(), session.code
+        hub = _hubs.get(key)
+        if hub is None or hub.failed:
+            hub = _hubs[key] = cls(channel_layer, session)
+        return hub
+
+    # Hubs that couldn't subscribe, or stopped relaying, are replaced
+    @property
+    def failed(self):
+        if not self.starting.done():
+            return False
+        return self.starting.exception() is not None or self.tasks[0].done()
+
+    async def start(self):
+        self.channel = await self.channel_layer.new_channel()
+        for group in self.groups:
+            await self.channel_layer.group_add(group, self.channel)
+        self.tasks = [asyncio.create_task(self.relay())]
+        if PING_INTERVAL:
+            self.tasks.append(asyncio.create_task(self.ping()))
+
+    async def join(self, spectator):
+        await self.starting
+        self.spectators.add(spectator)
+        await self.register()
+
+    async def leave(self, spectator):
+        if spectator not in self.spectators:
+            return
+        self.spectators.discard(spectator)
+        if self.spectators:
+            return await self.register()
+        await self.stop()
+
+    # The last spectator leaving unsubscribes this process from the session
+    async def stop(self):
+        _hubs.pop((asyncio.get_running_loop(), self.code), None)
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self.channel_layer.forget_channel(self.channel)
+        await heartbeats.unregister(self.channel_layer, self.channel)
+        for group in self.groups:
+            await self.channel_layer.group_discard(group, self.channel)
+
+    # Let other workers uncount the spectators if this one stops
+    async def register(self):
+        await heartbeats.register(
+            self.channel_layer,
+            self.channel,
+            {
+                "role": "guest",
+                "code": self.code,
+                "host_group": self.host_group,
+                "groups": self.groups,
+                "other_group": self.host_group,
+                "count": len(self.spectators),
+            },
+        )
+
+    # An event that can't be relayed is skipped, but if nothing more can be
+    # received the streams end, and later spectators get a new hub
+    async def relay(self):
+        try:
+            while True:
+                event = await self.channel_layer.receive(self.channel)
+                try:
+                    content = self.encode(event)
+                    if content is not None:
+                        await self.write(event_frame(content), event.get("topic"))
+                except Exception as error:
+                    print(f"! Unable to relay {event['type']} to {self.code}: {error}")
+                if event["type"] == "on_kick":
+                    return await self.close()
+        except Exception as error:
+            print(f"! Stopped relaying to spectators of {self.code}: {error}")
+            await self.close()
+
+    # The text guests would receive for an event, if spectators receive it
+    @staticmethod
+    def encode(event):
+        if event["type"] == "on_send":
+            return json.dumps(event["data"])
+        if event["type"] == "on_send_text":
+            return event["text"]
+        if event["type"] == "on_host_away":
+            message = "Host disconnected, waiting for it to return"
+            return json.dumps(
+                {
+                    "type": "server_host_away",
+                    "message": message,
+                    "seconds": event["seconds"],
+                }
+            )
+        if event["type"] == "on_kick":
+            return json.dumps(
+                {"type": "server_disconnect", "message": event["message"]}
+            )
+
+    async def write(self, frame, topic=None):
+        for spectator in list(self.spectators):
+            if spectator.wants(topic):
+                await spectator.send_body(frame, more_body=True)
+
+    # Comments keep idle streams open through proxies
+    async def ping(self):
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            await self.write(b": ping\n\n")
+
+    # The session ended, so every stream ends
+    async def close(self):
+        spectators = list(self.spectators)
+        self.spectators.clear()
+        for spectator in spectators:
+            await spectator.send_body(b"")
+        await self.stop()
+
+
+def event_frame(text):
+    lines = "".join(f"data: {line}\n" for line in text.split("\n"))
+    return f"{lines}\n".encode()
+
+
+# Read-only stream of a public session for guests that only watch, as
+# Server-Sent Events. Spectators count as guests, but aren't announced.
+class SpectatorConsumer(AsyncHttpConsumer):
+    # Spectators share their hub's channel instead of each having one
+    channel_layer_alias = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hub = None
+        self.topics = None
+
+    # The response stays open after the request has been handled, until the
+    # spectator disconnects
+    async def http_request(self, message):
+        if "body" in message:
+            self.body.append(message["body"])
+        if not message.get("more_body"):
+            await self.handle(b"".join(self.body))
+
+    async def handle(self, body):
+        code = self.scope["url_route"]["kwargs"]["code"]
+        session = await session_store.get_by_code(code)
+        if not session or not session.service.allow_public_code:
+            return await self.reject(404, "Invalid code")
+
+        channel_layer = get_channel_layer()
+        limit = session.service.max_guests
+        if await SessionCounters(channel_layer).add(code, "guest", 1, limit) is None:
+            return await self.reject(503, "Session is full")
+
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        if query.get("topics"):
+            self.topics = set(",".join(query["topics"]).split(","))
+
+        await self.send_headers(
+            headers=[
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ]
+        )
+        text = await SessionState(channel_layer, session.host_group).get_text()
+        if text is not None:
+            frame = event_frame(f'{{"type": "server_state", "state": {text}}}')
+            await self.send_body(frame, more_body=True)
+        else:
+            await self.send_body(b": connected\n\n", more_body=True)
+
+        self.hub = SpectatorHub.get(channel_layer, session)
+        await self.hub.join(self)
+
+    async def reject(self, status, message):
+        await self.send_response(
+            status,
+            message.encode(),
+            headers=[(b"content-type", b"text/plain")],
+        )
+        raise StopConsumer()
+
+    def wants(self, topic):
+        if self.topics is None or topic is None:
+            return True
+        return topic in self.topics or str(topic).startswith("server_")
+
+    async def disconnect(self):
+        if self.hub:
+            await self.hub.leave(self)
+            await SessionCounters(self.hub.channel_layer).add(
+                self.hub.code, "guest", -1
+            )
@@ -0,0 +1,46 @@
+import json
+from channels_redis.core import RedisChannelLayer
+from .registry import REGISTRY_EXPIRY
+
+
+# Latest state published by a session's host, kept as JSON next to the
+# session's user registry, for clients and guests joining later
+class SessionState:
+    def __init__(self, channel_layer: RedisChannelLayer, host_group):
+        self.key = self.state_key(host_group)
+        index = channel_layer.consistent_hash(host_group)
+        self.redis = channel_layer.connection(index)
+
+    @staticmethod
+    def state_key(host_group):
+        return f"{host_group}:state"
+
+    # The state as JSON text, or None if the host hasn't published one
+    async def get_text(self):
+        text = await self.redis.get(self.key)
+        return text.decode() if text else None
+
+    async def get(self):
+        text = await self.get_text()
+        return json.loads(text) if text else None
+
+    async def set(self, state):
+        await self.redis.set(self.key, json.dumps(state), ex=REGISTRY_EXPIRY)
+
+    async def clear(self):
+        await self.redis.delete(self.key)
+
+
+# Apply a JSON merge patch (RFC 7396), where null removes a key
+def merge_patch(target, patch):
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    target = dict(target)
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = merge_patch(target.get(key), value)
+    return target
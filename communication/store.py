@@ -0,0 +1,346 @@
+import uuid
+from datetime import datetime
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from .cache import token_cache
+from .codes import code_pool
+from .tasks import run_periodically
+
+from .models import Service, Session, safe_string
+
+# Seconds between copies of the sessions in Redis to the database
+SNAPSHOT_INTERVAL = getattr(settings, "OMNI_SESSION_SNAPSHOT_INTERVAL", 30)
+
+# Codes tried for a new session before giving up, when others took them
+CREATE_ATTEMPTS = 5
+
+
+# Sessions stored as database rows, the default
+class DatabaseSessionStore:
+    in_database = True
+
+    def start(self, channel_layer):
+        pass
+
+    # Codes come from the pool, or are generated in the database if the pool
+    # is unavailable. That must happen in one transaction, which the async ORM
+    # can't do yet, so it's the only synchronous step.
+    @database_sync_to_async
+    def create(self, service):
+        for attempt in range(CREATE_ATTEMPTS):
+            code = code_pool.allocate()
+            try:
+                with transaction.atomic():
+                    return service.add_session(code)
+            except IntegrityError:
+                # A code taken outside the pool stays marked as used, and the
+                # next one is tried. Other errors, such as the service having
+                # been deleted, return the code to the pool.
+                taken = code and Session.objects.filter(code=code).exists()
+                if not taken:
+                    code_pool.release(code)
+                if not taken or attempt == CREATE_ATTEMPTS - 1:
+                    raise
+
+    # The most recent session of a service. Misses load it like the resolver's
+    # cached lookups do.
+    async def current(self, service):
+        return await token_cache.get_or_load(
+            ("session", str(service.pk)),
+            database_sync_to_async(
+                lambda: Session.objects.select_related("service")
+                .filter(service=service)
+                .last()
+            ),
+        )
+
+    async def get_by_code(self, code):
+        return await token_cache.get_or_load(
+            ("code", code),
+            database_sync_to_async(
+                lambda: Session.objects.select_related("service")
+                .filter(code=code)
+                .first()
+            ),
+        )
+
+    @database_sync_to_async
+    def delete(self, code):
+        deleted, _ = Session.objects.filter(code=code).delete()
+        return bool(deleted)
+
+    # Every session, in lists of up to `batch` sessions, one query per list
+    async def iter_sessions(self, batch):
+        after = 0
+        while True:
+            sessions = await self.sessions_after(after, batch)
+            if not sessions:
+                return
+            yield sessions
+            after = sessions[-1].pk
+
+    @database_sync_to_async
+    def sessions_after(self, pk, batch):
+        return list(
+            Session.objects.only("code", "group_key", "created_on")
+            .filter(pk__gt=pk)
+            .order_by("pk")[:batch]
+        )
+
+    # Delete many sessions in one query, returning how many existed
+    @database_sync_to_async
+    def delete_many(self, codes):
+        deleted, _ = Session.objects.filter(code__in=codes).delete()
+        return deleted
+
+    # The codes among `codes` of sessions that exist
+    @database_sync_to_async
+    def existing(self, codes):
+        return set(
+            Session.objects.filter(code__in=codes).values_list("code", flat=True)
+        )
+
+    # Update the guest counts of many sessions, given as a dict of code to count
+    @database_sync_to_async
+    def save_guest_counts(self, counts):
+        sessions = list(Session.objects.filter(code__in=counts))
+        for session in sessions:
+            session.guest_count = counts[session.code]
+        Session.objects.bulk_update(sessions, ["guest_count"])
+
+
+# Sessions stored in Redis, so that connecting needs no database queries once
+# services are cached. Sessions are unsaved Session instances, and are copied
+# to the database periodically for the admin to show.
+class RedisSessionStore:
+    in_database = False
+
+    # Key of a session's hash, and of the code of a service's current session
+    SESSION_KEY = "omni:session:{}"
+    CURRENT_KEY = "omni:service:{}:session"
+    # Set of the codes of all sessions
+    INDEX_KEY = "omni:sessions"
+
+    # Delete a session, and unset it as its service's current session
+    DELETE = """
+    local service = redis.call('HGET', KEYS[1], 'service')
+    if not service then
+        return 0
+    end
+    redis.call('DEL', KEYS[1])
+    redis.call('SREM', KEYS[2], ARGV[1])
+    local current = ARGV[2] .. service .. ARGV[3]
+    if redis.call('GET', current) == ARGV[1] then
+        redis.call('DEL', current)
+    end
+    return 1
+    """
+
+    # Set guest counts, skipping sessions that have been deleted
+    SAVE_GUEST_COUNTS = """
+    for i, key in ipairs(KEYS) do
+        if redis.call('EXISTS', key) == 1 then
+            redis.call('HSET', key, 'guest_count', ARGV[i])
+        end
+    end
+    """
+
+    @property
+    def redis(self):
+        # Every key lives on the first shard, so the index stays consistent
+        return get_channel_layer().connection(0)
+
+    def start(self, channel_layer):
+        run_periodically(
+            "session_snapshot", SNAPSHOT_INTERVAL, self.snapshot, channel_layer
+        )
+
+    async def create(self, service):
+        code = await sync_to_async(code_pool.allocate, thread_sensitive=False)()
+        if not code:
+            return None
+
+        session = Session(
+            service=service,
+            group_key=safe_string(service.title),
+            code=code,
+            created_on=timezone.now(),
+        )
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(
+            self.SESSION_KEY.format(code),
+            mapping={
+                "service": str(service.pk),
+                "group_key": session.group_key,
+                "created_on": session.created_on.isoformat(),
+                "guest_count": 0,
+            },
+        )
+        pipe.set(self.CURRENT_KEY.format(service.pk), code)
+        pipe.sadd(self.INDEX_KEY, code)
+        await pipe.execute()
+        return session
+
+    async def current(self, service):
+        code = await self.redis.get(self.CURRENT_KEY.format(service.pk))
+        if code:
+            return await self.get_by_code(code.decode(), service)
+
+    async def get_by_code(self, code, service=None):
+        fields = await self.redis.hgetall(self.SESSION_KEY.format(code))
+        if not fields:
+            return None
+
+        fields = {key.decode(): value.decode() for key, value in fields.items()}
+        if service is None:
+            service = await self.get_service(fields["service"])
+            if service is None:
+                return None
+
+        return Session(
+            service=service,
+            group_key=fields["group_key"],
+            code=code,
+            created_on=datetime.fromisoformat(fields["created_on"]),
+            guest_count=int(fields["guest_count"]),
+        )
+
+    async def get_service(self, pk):
+        return await token_cache.get_or_load(
+            ("service", pk),
+            database_sync_to_async(lambda: Service.objects.filter(pk=pk).first()),
+        )
+
+    async def delete(self, code):
+        prefix, suffix = self.CURRENT_KEY.split("{}")
+        deleted = await self.redis.eval(
+            self.DELETE,
+            2,
+            self.SESSION_KEY.format(code),
+            self.INDEX_KEY,
+            code,
+            prefix,
+            suffix,
+        )
+        if deleted:
+            await sync_to_async(code_pool.release, thread_sensitive=False)(code)
+        return bool(deleted)
+
+    # Every session, in lists of up to `batch` sessions. The index is scanned
+    # incrementally, so sessions created meanwhile may be missed.
+    async def iter_sessions(self, batch):
+        cursor = 0
+        while True:
+            cursor, codes = await self.redis.sscan(self.INDEX_KEY, cursor, count=batch)
+            codes = [code.decode() for code in codes]
+            pipe = self.redis.pipeline(transaction=False)
+            for code in codes:
+                pipe.hmget(self.SESSION_KEY.format(code), "group_key", "created_on")
+            sessions = [
+                Session(
+                    group_key=group_key.decode(),
+                    code=code,
+                    created_on=datetime.fromisoformat(created_on.decode()),
+                )
+                for code, (group_key, created_on) in zip(codes, await pipe.execute())
+                if group_key
+            ]
+            if sessions:
+                yield sessions
+            if not cursor:
+                return
+
+    async def delete_many(self, codes):
+        prefix, suffix = self.CURRENT_KEY.split("{}")
+        pipe = self.redis.pipeline(transaction=False)
+        for code in codes:
+            pipe.eval(
+                self.DELETE,
+                2,
+                self.SESSION_KEY.format(code),
+                self.INDEX_KEY,
+                code,
+                prefix,
+                suffix,
+            )
+        deleted = [code for code, done in zip(codes, await pipe.execute()) if done]
+        await sync_to_async(code_pool.release, thread_sensitive=False)(*deleted)
+        return len(deleted)
+
+    async def existing(self, codes):
+        codes = list(codes)
+        pipe = self.redis.pipeline(transaction=False)
+        for code in codes:
+            pipe.exists(self.SESSION_KEY.format(code))
+        return {code for code, found in zip(codes, await pipe.execute()) if found}
+
+    async def save_guest_counts(self, counts):
+        keys = [self.SESSION_KEY.format(code) for code in counts]
+        await self.redis.eval(
+            self.SAVE_GUEST_COUNTS, len(keys), *keys, *counts.values()
+        )
+
+    # Snapshot
+
+    async def snapshot(self):
+        codes = [code.decode() for code in await self.redis.smembers(self.INDEX_KEY)]
+        pipe = self.redis.pipeline(transaction=False)
+        for code in codes:
+            pipe.hgetall(self.SESSION_KEY.format(code))
+
+        sessions = {}
+        for code, fields in zip(codes, await pipe.execute()):
+            if fields:
+                fields = {key.decode(): value.decode() for key, value in fields.items()}
+                sessions[code] = fields
+        await self.write_snapshot(sessions)
+
+    # Make the session table match the sessions in Redis
+    @database_sync_to_async
+    @transaction.atomic
+    def write_snapshot(self, sessions):
+        rows = {session.code: session for session in Session.objects.all()}
+
+        stale = [
+            code
+            for code, row in rows.items()
+            if code not in sessions or str(row.service_id) != sessions[code]["service"]
+        ]
+        Session.objects.filter(code__in=stale).delete()
+
+        created, updated = [], []
+        services = set(Service.objects.values_list("pk", flat=True))
+        for code, fields in sessions.items():
+            guest_count = int(fields["guest_count"])
+            row = rows.get(code)
+            if row is None or code in stale:
+                if uuid.UUID(fields["service"]) not in services:
+                    continue
+                created.append(
+                    Session(
+                        service_id=fields["service"],
+                        group_key=fields["group_key"],
+                        code=code,
+                        guest_count=guest_count,
+                    )
+                )
+            elif row.guest_count != guest_count:
+                row.guest_count = guest_count
+                updated.append(row)
+
+        Session.objects.bulk_create(created)
+        Session.objects.bulk_update(updated, ["guest_count"])
+
+
+session_store = import_string(
+    getattr(
+        settings,
+        "OMNI_SESSION_STORE",
+        "communication.store.DatabaseSessionStore",
+    )
+)()
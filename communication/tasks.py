@@ -0,0 +1,32 @@
+import asyncio
+from redis import RedisError
+
+_tasks = {}
+
+
+# Run a job every `interval` seconds in the background of this event loop,
+# first after `delay` seconds if given. When several workers run the same job,
+# a Redis lock lets only one of them run it per interval.
+def run_periodically(name, interval, job, channel_layer, delay=None):
+    loop = asyncio.get_running_loop()
+    if (loop, name) not in _tasks:
+        _tasks[loop, name] = loop.create_task(
+            _run_periodically(name, interval, job, channel_layer, delay)
+        )
+
+
+async def _run_periodically(name, interval, job, channel_layer, delay):
+    lock = f"omni:lock:{name}"
+    while True:
+        await asyncio.sleep(interval if delay is None else delay)
+        delay = None
+        try:
+            # The lock expires shortly before the next run is due
+            redis = channel_layer.connection(0)
+            if not await redis.set(lock, 1, nx=True, px=int(interval * 900)):
+                continue
+            await job()
+        except (RedisError, OSError) as error:
+            print(f"! Unable to run {name}: {error}")
+        except Exception as error:
+            print(f"! {name} failed: {error!r}")
@@ -0,0 +1,101 @@
+import asyncio, time
+from django.conf import settings
+from .counters import SessionCounters
+from .history import SessionHistory
+from .registry import UserRegistry
+from .state import SessionState
+from .store import session_store
+from .tasks import run_periodically
+
+# Seconds between checks for sessions whose host didn't return in time
+SWEEP_INTERVAL = getattr(settings, "OMNI_TEARDOWN_SWEEP_INTERVAL", 5)
+
+# Sorted set of the codes of sessions waiting for their host, scored by the
+# time they are torn down if the host doesn't return
+TEARDOWNS_KEY = "omni:teardowns"
+
+
+# Delete a session's groups, user registry, state, history and counts in a few
+# pipelined commands, leaving nothing for its members to clean up one by one.
+# Returns the number of members each group had.
+async def teardown_session(channel_layer, code, host_group, client_group, guest_group):
+    members = await channel_layer.group_delete(host_group, client_group, guest_group)
+
+    # The registry, state and history live on the same shard
+    index = channel_layer.consistent_hash(host_group)
+    await channel_layer.connection(index).delete(
+        UserRegistry.registry_key(host_group),
+        SessionState.state_key(host_group),
+        SessionHistory.history_key(host_group),
+    )
+    await SessionCounters(channel_layer).delete(code)
+    return members
+
+
+# Delete a session and kick its guests. Returns whether the session existed,
+# and the number of members each group had.
+async def end_session(channel_layer, code, host_group, client_group, guest_group):
+    deleted = await session_store.delete(code)
+    await channel_layer.group_send(
+        guest_group,
+        {"type": "on_kick", "message": "Session ended by host", "closed": True},
+    )
+    members = await teardown_session(
+        channel_layer, code, host_group, client_group, guest_group
+    )
+    return deleted, members
+
+
+# Grace period
+
+
+# End a session after a delay, unless its host returns first. The worker
+# scheduling it ends it on time, and any worker does so if that one is gone.
+async def schedule_teardown(channel_layer, code, delay):
+    redis = channel_layer.connection(0)
+    await redis.zadd(TEARDOWNS_KEY, {code: time.time() + delay})
+    asyncio.get_running_loop().call_later(
+        delay, lambda: asyncio.create_task(claim_teardown(channel_layer, code))
+    )
+
+
+# Returns True if the teardown was still pending, and now won't happen
+async def cancel_teardown(channel_layer, code):
+    return await channel_layer.connection(0).zrem(TEARDOWNS_KEY, code) == 1
+
+
+# Only the worker removing the pending teardown ends the session
+async def claim_teardown(channel_layer, code):
+    if not await cancel_teardown(channel_layer, code):
+        return
+
+    session = await session_store.get_by_code(code)
+    if session is None:
+        return
+
+    _, members = await end_session(
+        channel_layer,
+        code,
+        session.host_group,
+        session.client_group,
+        session.guest_group,
+    )
+    print(
+        f"- Ended session {code} with {members[session.guest_group]} guests "
+        f"after its host didn't return"
+    )
+
+
+async def sweep_teardowns(channel_layer):
+    due = await channel_layer.connection(0).zrangebyscore(TEARDOWNS_KEY, 0, time.time())
+    for code in due:
+        await claim_teardown(channel_layer, code.decode())
+
+
+def sweep_periodically(channel_layer):
+    run_periodically(
+        "teardown_sweep",
+        SWEEP_INTERVAL,
+        lambda: sweep_teardowns(channel_layer),
+        channel_layer,
+    )
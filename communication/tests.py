@@ -1,3 +1,474 @@
-from django.test import TestCase
+import asyncio, fakeredis, io, json, msgpack, threading
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import IntegrityError
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from fakeredis import aioredis
+from .cache import TokenCache, token_cache
+from .codes import random_code
+from .consumers import OmniConsumer
+from .counters import SessionCounters
+from .heartbeat import seconds_setting
+from .layers import DISCONNECT, LATEST, LocalFanoutChannelLayer
+from .publish import publish
+from .routing import http_urlpatterns
+from .spectators import SpectatorHub
+from .store import session_store
+from .resolver import resolve_token, HOST, CLIENT, GUEST
 
-# Create your tests here.
+from .models import Service
+
+
+# Patch for the rest of a test, including tearDown. Class decorators would
+# leave setUp and tearDown talking to the real Redis.
+def patch(test, target, new):
+    patcher = mock.patch(target, new)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return new
+
+
+# Session creation goes through database_sync_to_async, which closes the
+# connection of an enclosing test transaction, so these tests commit instead
+class ResolveTokenTests(TransactionTestCase):
+    def setUp(self):
+        patch(self, "communication.cache.get_publisher", mock.Mock())
+        patch(self, "communication.codes.code_pool.allocate", random_code)
+        self.release = patch(self, "communication.codes.code_pool.release", mock.Mock())
+        self.service = Service.objects.create(title="Exhibit")
+        self.public_service = Service.objects.create(
+            title="Public exhibit", allow_public_code=True
+        )
+        self.session = self.service.add_session()
+        self.public_session = self.public_service.add_session()
+        token_cache.clear()
+
+    def tearDown(self):
+        token_cache.clear()
+
+    def resolve(self, token):
+        return async_to_sync(resolve_token)(token)
+
+    def test_host(self):
+        with self.assertNumQueries(2):
+            resolution = self.resolve(str(self.service.host_token))
+        self.assertEqual(resolution.role, HOST)
+        self.assertEqual(resolution.session, self.session)
+        self.assertFalse(resolution.created)
+
+    def test_host_creates_session(self):
+        self.session.delete()
+        token_cache.clear()
+        with self.assertNumQueries(5):
+            resolution = self.resolve(str(self.service.host_token))
+        self.assertTrue(resolution.created)
+        self.assertEqual(resolution.session.service, self.service)
+
+    def test_public_host_creates_session(self):
+        with self.assertNumQueries(4):
+            resolution = self.resolve(str(self.public_service.host_token))
+        self.assertEqual(resolution.role, HOST)
+        self.assertTrue(resolution.created)
+        self.assertNotEqual(resolution.session, self.public_session)
+
+    def test_host_skips_taken_code(self):
+        codes = iter([self.public_session.code, "WXYZ"])
+        with mock.patch("communication.codes.code_pool.allocate", lambda: next(codes)):
+            resolution = self.resolve(str(self.public_service.host_token))
+        self.assertEqual(resolution.session.code, "WXYZ")
+
+    def test_create_gives_up_on_taken_codes(self):
+        code = self.public_session.code
+        with mock.patch("communication.codes.code_pool.allocate", lambda: code):
+            with self.assertRaises(IntegrityError):
+                async_to_sync(session_store.create)(self.public_service)
+        self.release.assert_not_called()
+
+    def test_create_for_deleted_service(self):
+        Service.objects.filter(pk=self.service.pk).delete()
+        self.release.reset_mock()
+        with mock.patch("communication.codes.code_pool.allocate", lambda: "WXYZ"):
+            with self.assertRaises(IntegrityError):
+                async_to_sync(session_store.create)(self.service)
+        self.release.assert_called_once_with("WXYZ")
+
+    def test_client(self):
+        with self.assertNumQueries(2):
+            resolution = self.resolve(str(self.service.client_token))
+        self.assertEqual(resolution.role, CLIENT)
+        self.assertEqual(resolution.session, self.session)
+
+        # Repeated connects are served from the token cache
+        with self.assertNumQueries(0):
+            self.resolve(str(self.service.client_token))
+
+    def test_guest(self):
+        with self.assertNumQueries(1):
+            resolution = self.resolve(self.public_session.code)
+        self.assertEqual(resolution.role, GUEST)
+        self.assertEqual(resolution.session, self.public_session)
+
+        with self.assertNumQueries(0):
+            self.resolve(self.public_session.code)
+
+    def test_guest_requires_public_service(self):
+        self.assertIsNone(self.resolve(self.session.code))
+
+    def test_invalid_token(self):
+        self.assertIsNone(self.resolve("NOPE"))
+        self.assertIsNone(self.resolve("0d1c2b3a-0000-4000-8000-000000000000"))
+
+
+class ServiceTests(SimpleTestCase):
+    def test_rate_limits_must_allow_messages(self):
+        for field in ["client_rate_limit", "guest_rate_limit", "service_rate_limit"]:
+            service = Service(title="Exhibit", **{field: 0})
+            with self.assertRaises(ValidationError) as context:
+                service.clean_fields()
+            self.assertEqual(list(context.exception.message_dict), [field])
+
+
+# Messages that can't be delivered are reported without touching Redis
+class PublishTests(TransactionTestCase):
+    def setUp(self):
+        patch(self, "communication.cache.get_publisher", mock.Mock())
+        self.service = Service.objects.create(title="Exhibit")
+        token_cache.clear()
+
+    def tearDown(self):
+        token_cache.clear()
+
+    def test_publish_api(self):
+        response = self.client.post(
+            "/api/publish/", {"message": "hi"}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(
+            "/api/publish/",
+            {"messages": [{"token": "NOPE", "data": {}}]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(), {"results": [{"ok": False, "error": "Invalid token"}]}
+        )
+
+    def test_rejected_messages(self):
+        host_token = str(self.service.host_token)
+        results = async_to_sync(publish)(
+            [
+                "hi",
+                {"data": {}},
+                {"token": host_token, "data": "hi"},
+                {"token": host_token, "group": "everyone", "data": {}},
+                {"token": str(self.service.client_token), "data": {}},
+                {"token": host_token, "data": {}},
+            ]
+        )
+        self.assertEqual(
+            [result["error"] for result in results],
+            [
+                "Malformed message. Expected an object.",
+                'Missing "token"',
+                'Malformed data. Expected "data" to be an object.',
+                "Unknown group. Expected one of clients, guests, host.",
+                "Invalid token",
+                "No open session",
+            ],
+        )
+
+
+# Point channel layers and publishers at a fake Redis server for a test
+def patch_redis(test):
+    server = fakeredis.FakeServer()
+
+    def get_connection(loop_layer, index):
+        if index not in loop_layer._connections:
+            loop_layer._connections[index] = aioredis.FakeRedis(server=server)
+        return loop_layer._connections[index]
+
+    def get_publisher():
+        return fakeredis.FakeRedis(server=server)
+
+    patch(test, "channels_redis.core.RedisLoopLayer.get_connection", get_connection)
+    patch(test, "communication.cache.get_publisher", get_publisher)
+    patch(test, "communication.codes.get_publisher", get_publisher)
+    # Layers and scripts cached by earlier tests belong to other servers
+    patch(test, "channels.layers.channel_layers.backends", {})
+    patch(test, "communication.codes.code_pool.scripts", None)
+
+
+class TokenCacheTests(SimpleTestCase):
+    def test_load_racing_an_invalidation_isnt_cached(self):
+        cache = TokenCache(ttl=60, max_size=10)
+        service = Service(pk=1)
+
+        async def load():
+            cache.invalidate("1")
+            return service
+
+        self.assertIs(async_to_sync(cache.get_or_load)("key", load), service)
+        self.assertIsNone(cache.get("key"))
+
+        async def load_again():
+            return service
+
+        async_to_sync(cache.get_or_load)("key", load_again)
+        self.assertIs(cache.get("key"), service)
+
+
+class SecondsSettingTests(SimpleTestCase):
+    @override_settings(OMNI_IDLE_TIMEOUT=None, OMNI_PING_INTERVAL=0.5)
+    def test_valid(self):
+        self.assertIsNone(seconds_setting("OMNI_IDLE_TIMEOUT", 60, optional=True))
+        self.assertEqual(seconds_setting("OMNI_PING_INTERVAL", 20), 0.5)
+        self.assertEqual(seconds_setting("OMNI_UNSET", 20), 20)
+
+    @override_settings(OMNI_IDLE_TIMEOUT=0, OMNI_PING_INTERVAL=None)
+    def test_invalid(self):
+        with self.assertRaises(ImproperlyConfigured):
+            seconds_setting("OMNI_IDLE_TIMEOUT", 60, optional=True)
+        with self.assertRaises(ImproperlyConfigured):
+            seconds_setting("OMNI_PING_INTERVAL", 20)
+
+
+# Two channel layers sharing a fake Redis server stand in for two workers
+class LocalFanoutChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        patch_redis(self)
+        self.layer = LocalFanoutChannelLayer()
+        self.other_layer = LocalFanoutChannelLayer()
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 1)
+
+    async def test_local_and_remote_members_keep_order(self):
+        local = await self.layer.new_channel()
+        remote = await self.other_layer.new_channel()
+        await self.layer.group_add("group", local)
+        await self.layer.group_add("group", remote)
+
+        await self.layer.group_send("group", {"type": "test", "n": 1})
+        await self.layer.group_send("group", {"type": "test", "n": 2})
+
+        # Local members have their messages before anything is received
+        self.assertEqual(self.layer.backlog(local), 2)
+        for channel, layer in [(local, self.layer), (remote, self.other_layer)]:
+            self.assertEqual((await self.receive(layer, channel))["n"], 1)
+            self.assertEqual((await self.receive(layer, channel))["n"], 2)
+
+        # Nor do they get a second copy through Redis
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.layer.backlog(local), 0)
+
+    async def test_exited_channel_is_dropped(self):
+        channel = await self.layer.new_channel()
+        await self.layer.group_add("group", channel)
+        receiving = asyncio.create_task(self.layer.receive(channel))
+        await asyncio.sleep(0)
+        receiving.cancel()
+        await asyncio.gather(receiving, return_exceptions=True)
+
+        self.assertNotIn("group", self.layer.local_groups)
+        await self.layer.send(channel, {"type": "test"})
+        await self.layer.group_send("group", {"type": "test"})
+        await asyncio.sleep(0.1)
+        self.assertNotIn(channel, self.layer.receive_buffer)
+
+    async def test_latest_keeps_one_message_per_topic(self):
+        channel = await self.layer.new_channel()
+        self.layer.set_backlog_limit(channel, 3, LATEST)
+        events = [
+            ("on_send", "round"),
+            ("on_send", "score"),
+            ("on_send_many", ["score"]),
+            ("on_send", "score"),
+            ("on_send_many", ["score"]),
+        ]
+        for n, (event_type, key) in enumerate(events):
+            await self.layer.send(channel, {"type": event_type, "key": key, "n": n})
+
+        messages = [await self.receive(self.layer, channel) for _ in range(3)]
+        self.assertEqual([message["n"] for message in messages], [0, 3, 4])
+
+    async def test_backlog_limit_is_capped_at_capacity(self):
+        channel = await self.layer.new_channel()
+        self.layer.set_backlog_limit(channel, self.layer.capacity * 5, DISCONNECT)
+        for n in range(self.layer.capacity + 1):
+            await self.layer.send(channel, {"type": "test", "n": n})
+
+        self.assertIn(channel, self.layer.lagging)
+        message = await self.receive(self.layer, channel)
+        self.assertEqual(message, {"type": "on_backlog_exceeded"})
+
+    async def test_send_from_another_event_loop(self):
+        channel = await self.layer.new_channel()
+        self.layer.start_reader()
+
+        # Buffers belong to the receiving loop, so this goes through Redis
+        thread = threading.Thread(
+            target=asyncio.run, args=[self.layer.send(channel, {"type": "test"})]
+        )
+        thread.start()
+        await asyncio.get_running_loop().run_in_executor(None, thread.join)
+        self.assertEqual(await self.receive(self.layer, channel), {"type": "test"})
+
+
+class SessionCountersTests(SimpleTestCase):
+    def setUp(self):
+        patch_redis(self)
+
+    async def test_limits(self):
+        counters = SessionCounters(LocalFanoutChannelLayer())
+        self.assertIsNone(await counters.add("ABCD", "guest", 1, 0))
+        self.assertEqual(await counters.add("ABCD", "guest", 1, 1), 1)
+        self.assertIsNone(await counters.add("ABCD", "guest", 1, 1))
+        self.assertEqual(await counters.add("ABCD", "guest", 1), 2)
+        self.assertEqual(await counters.add("ABCD", "guest", -1), 1)
+
+
+# Hosts, guests and spectators connected to one worker
+class OmniConsumerTests(TransactionTestCase):
+    def setUp(self):
+        patch_redis(self)
+        self.service = Service.objects.create(title="Exhibit", allow_public_code=True)
+        token_cache.clear()
+        patch(self, "sys.stdout", io.StringIO())
+
+    def tearDown(self):
+        token_cache.clear()
+
+    async def connect(self, content, use_msgpack=False):
+        communicator = WebsocketCommunicator(OmniConsumer.as_asgi(), "/ws/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()
+        if use_msgpack:
+            await communicator.send_to(bytes_data=msgpack.packb(content))
+        else:
+            await communicator.send_json_to(content)
+        return communicator
+
+    async def receive_all(self, communicator):
+        messages = []
+        while not await communicator.receive_nothing(0.2):
+            output = await communicator.receive_output()
+            if output["type"] == "websocket.close":
+                messages.append(output)
+            elif "bytes" in output and output["bytes"] is not None:
+                messages.append(msgpack.unpackb(output["bytes"]))
+            else:
+                messages.append(json.loads(output["text"]))
+        return messages
+
+    async def test_msgpack_guest_sends_to_json_host(self):
+        host = await self.connect({"token": str(self.service.host_token)})
+        code = (await self.receive_all(host))[0]["code"]
+        guest = await self.connect({"token": code}, use_msgpack=True)
+        await self.receive_all(guest)
+        await self.receive_all(host)
+
+        await guest.send_to(bytes_data=msgpack.packb({"type": "tap", "x": 1}))
+        messages = await self.receive_all(host)
+        self.assertEqual(messages[0]["type"], "tap")
+        self.assertEqual(messages[0]["x"], 1)
+
+        # Binary values have no JSON equivalent, so they never reach the host
+        await guest.send_to(bytes_data=msgpack.packb({"type": "tap", "x": b"\x00"}))
+        messages = await self.receive_all(guest)
+        self.assertEqual(messages[0]["type"], "server_error")
+        self.assertEqual(messages[-1]["type"], "websocket.close")
+        self.assertNotIn("tap", [m.get("type") for m in await self.receive_all(host)])
+        await host.disconnect()
+
+    async def test_targeted_messages(self):
+        host = await self.connect({"token": str(self.service.host_token)})
+        code = (await self.receive_all(host))[0]["code"]
+        guests = [await self.connect({"token": code}) for _ in range(2)]
+        for guest in guests:
+            await self.receive_all(guest)
+        users = [m["user"] for m in await self.receive_all(host) if "user" in m]
+
+        async def received():
+            return [[m["type"] for m in await self.receive_all(g)] for g in guests]
+
+        await host.send_json_to({"type": "one", "user": users[0]})
+        await host.send_json_to({"type": "both", "user": users})
+        await host.send_json_to({"type": "none", "user": []})
+        self.assertEqual(await received(), [["one", "both"], ["both"]])
+
+        messages = [
+            {"type": "none", "user": []},
+            {"type": "second", "user": [users[1]]},
+            {"type": "all"},
+        ]
+        await host.send_json_to({"type": "server_batch", "messages": messages})
+        self.assertEqual(await received(), [["all"], ["second", "all"]])
+        await host.disconnect()
+
+    async def test_raw_relay_envelope_cannot_be_forged(self):
+        self.service.raw_relay = True
+        self.service.validate_json = False
+        await database_sync_to_async(self.service.save)()
+        host = await self.connect({"token": str(self.service.host_token)})
+        code = (await self.receive_all(host))[0]["code"]
+        guest = await self.connect({"token": code})
+        await self.receive_all(guest)
+        await self.receive_all(host)
+
+        await guest.send_to(text_data='{"type": "tap"}')
+        messages = await self.receive_all(host)
+        self.assertEqual(messages[0]["data"], {"type": "tap"})
+
+        await guest.send_to(text_data='0, "user": "SPOOF"')
+        messages = await self.receive_all(guest)
+        self.assertEqual(messages[0]["type"], "server_error")
+        self.assertEqual(messages[-1]["type"], "websocket.close")
+        self.assertEqual(await self.receive_all(host), [])
+        await host.disconnect()
+
+    async def receive_body(self, spectator):
+        message = await asyncio.wait_for(spectator.output_queue.get(), 1)
+        self.assertEqual(message["type"], "http.response.body")
+        return message
+
+    async def test_spectators(self):
+        host = await self.connect({"token": str(self.service.host_token)})
+        code = (await self.receive_all(host))[0]["code"]
+
+        spectator = HttpCommunicator(
+            URLRouter(http_urlpatterns), "GET", f"/sse/{code}/"
+        )
+        await spectator.send_input({"type": "http.request"})
+        start = await asyncio.wait_for(spectator.output_queue.get(), 1)
+        self.assertEqual(start["status"], 200)
+        self.assertEqual(
+            (await self.receive_body(spectator))["body"], b": connected\n\n"
+        )
+        self.assertEqual(len(await self.receive_all(host)), 0)
+
+        await host.send_json_to({"type": "score", "n": 1})
+        message = await self.receive_body(spectator)
+        self.assertEqual(message["body"], b'data: {"type": "score", "n": 1}\n\n')
+
+        # Events that can't be relayed are skipped without stopping the stream
+        with mock.patch.object(SpectatorHub, "encode", side_effect=ValueError):
+            await host.send_json_to({"type": "score", "n": 2})
+            await asyncio.sleep(0.1)
+        await host.send_json_to({"type": "score", "n": 3})
+        self.assertIn(b'"n": 3', (await self.receive_body(spectator))["body"])
+
+        # The stream ends with the session
+        await host.disconnect()
+        self.assertIn(
+            b"server_disconnect", (await self.receive_body(spectator))["body"]
+        )
+        message = await self.receive_body(spectator)
+        self.assertFalse(message["more_body"])
+        await spectator.send_input({"type": "http.disconnect"})
+        await spectator.wait(1)
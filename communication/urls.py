@@ -3,6 +3,7 @@ from . import views
 
 urlpatterns = [
     path("", views.index),
+    path("api/publish/", views.publish_messages),
     # re_path("^get_example/?$", views.get_example),
     # re_path("^post_example/?$", views.post_example),
 ]
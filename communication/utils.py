@@ -28,6 +28,10 @@ def explain_websocket_code(code):
         1014: "Server acting as gateway received an invalid response",
         1015: "Transport Layer Security handshake failure",
         4000: "Kicked by new host",
+        4001: "Session is full",
+        4002: "Rate limit exceeded",
+        4003: "Too slow to receive messages",
+        4004: "Connection timed out",
     }
     if code in close_codes:
         return close_codes[code]
@@ -1,10 +1,16 @@
 import uuid
 
+from asgiref.sync import async_to_sync
 from django.shortcuts import render
 from django.http import HttpResponse, JsonResponse, Http404
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.response import Response
-from rest_framework.decorators import api_view
+from rest_framework.decorators import (
+    api_view,
+    authentication_classes,
+    permission_classes,
+)
+from .publish import PUBLISH_MAX_MESSAGES, publish
 
 from .models import Service
 
@@ -17,6 +23,22 @@ def index(request):
     )
 
 
+# Publish messages to sessions without holding a websocket. Every message is
+# authenticated by the host token it carries, so no other credentials are used.
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([])
+def publish_messages(request):
+    messages = request.data.get("messages") if isinstance(request.data, dict) else None
+    if not isinstance(messages, list):
+        return Response({"error": 'Expected {"messages": [...]}'}, status=400)
+    if len(messages) > PUBLISH_MAX_MESSAGES:
+        error = f"Too many messages. At most {PUBLISH_MAX_MESSAGES} are accepted."
+        return Response({"error": error}, status=400)
+
+    return Response({"results": async_to_sync(publish)(messages)})
+
+
 # @api_view(["GET"])
 # def get_example(request):
 #     return Response(
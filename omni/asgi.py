@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 import django, os
 
 from django.core.asgi import get_asgi_application
+from django.urls import re_path
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 
@@ -20,7 +21,10 @@ import communication.routing  # Requires models
 
 application = ProtocolTypeRouter(
     {
-        "http": http,
+        # Spectators stream from the SSE endpoint, everything else is Django
+        "http": URLRouter(
+            communication.routing.http_urlpatterns + [re_path(r"", http)]
+        ),
         "websocket": AuthMiddlewareStack(
             URLRouter(communication.routing.websocket_urlpatterns)
         ),
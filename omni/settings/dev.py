@@ -41,7 +41,8 @@ ASGI_APPLICATION = "omni.asgi.application"
 CHANNEL_LAYERS = {
     "default": {
         # "BACKEND": "channels.layers.InMemoryChannelLayer",
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        # Redis channel layer with in-memory delivery within each process
+        "BACKEND": "communication.layers.LocalFanoutChannelLayer",
         "CONFIG": {
             "hosts": [("127.0.0.1", 6379)],
             "group_expiry": 12 * 3600,
@@ -49,6 +50,55 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Per-process cache of resolved tokens used when authenticating websockets
+OMNI_TOKEN_CACHE_TTL = 60  # Seconds
+OMNI_TOKEN_CACHE_SIZE = 4096
+
+# Serialize broadcast messages once in the sender instead of in every receiver
+OMNI_ENCODE_BROADCASTS_ONCE = True
+
+# Batching of joins and leaves for services with coalesced presence
+OMNI_PRESENCE_INTERVAL = 250  # Milliseconds
+OMNI_PRESENCE_MAX_EVENTS = 100
+
+# Public codes pre-generated in Redis, refilled when running low
+OMNI_CODE_POOL_SIZE = 1000
+OMNI_CODE_POOL_LOW_WATER = 250
+
+# Where sessions are kept. With RedisSessionStore, the session table is only a
+# snapshot for the admin, refreshed every OMNI_SESSION_SNAPSHOT_INTERVAL.
+OMNI_SESSION_STORE = "communication.store.DatabaseSessionStore"
+# OMNI_SESSION_STORE = "communication.store.RedisSessionStore"
+OMNI_SESSION_SNAPSHOT_INTERVAL = 30  # Seconds
+
+# Seconds between writes of live guest counts to the sessions
+OMNI_COUNTS_FLUSH_INTERVAL = 5
+
+# Host messages are kept in a session's history for at most this many seconds,
+# and are replayed to resuming clients in batches of this many messages
+OMNI_HISTORY_MAX_AGE = 60
+OMNI_HISTORY_REPLAY_BATCH = 100
+
+# Seconds between checks for sessions whose host didn't return in time, in
+# case the worker the host left from is gone
+OMNI_TEARDOWN_SWEEP_INTERVAL = 5
+
+# Connections quiet for OMNI_PING_INTERVAL seconds are pinged, and closed after
+# OMNI_IDLE_TIMEOUT, if set. None disables either. Clients that only listen
+# must answer pings before an idle timeout is enabled.
+OMNI_PING_INTERVAL = 20
+OMNI_IDLE_TIMEOUT = None
+
+# Workers vouch for their connections every OMNI_ALIVE_INTERVAL seconds. Those
+# not vouched for in OMNI_ALIVE_TIMEOUT are swept up every OMNI_REAP_INTERVAL.
+OMNI_ALIVE_INTERVAL = 20
+OMNI_ALIVE_TIMEOUT = 80
+OMNI_REAP_INTERVAL = 60
+
+# Messages that may wait for a client or guest falling behind, unless its
+# service sets its own limit. Can't exceed the channel layer's capacity.
+OMNI_BACKLOG_LIMIT = 100
+
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -141,3 +191,12 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # Handle css
 mimetypes.add_type("text/css", ".css", True)
+
+# Sessions without a live host, and Redis keys of sessions that are gone, are
+# deleted shortly after startup and every OMNI_RECONCILE_INTERVAL seconds, in
+# batches of OMNI_RECONCILE_BATCH
+OMNI_RECONCILE_INTERVAL = 3600
+OMNI_RECONCILE_BATCH = 500
+
+# Most messages accepted in one request to the publish API
+OMNI_PUBLISH_MAX_MESSAGES = 1000
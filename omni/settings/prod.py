@@ -20,6 +20,9 @@ DATABASES = {
         "PASSWORD": "password",
         "HOST": "127.0.0.1",
         "PORT": "5432",
+        # Keep connections open between queries instead of reconnecting
+        "CONN_MAX_AGE": 600,
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 